@@ -1,11 +1,100 @@
+import asyncio
+import functools
+import json
+import logging
 import anthropic
-from typing import List, Optional, Dict, Any
+import httpx
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple
+from response_cache import ResponseCache, SemanticCache
+from rate_limiter import RateLimiter, RateLimitedAnthropic
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a prompt prefix that Anthropic may serve from its prompt cache
+CACHE_CONTROL = {"type": "ephemeral"}
+
+TOOL_CHOICE_AUTO = {"type": "auto"}
+TOOL_CHOICE_NONE = {"type": "none"}
+
+# Yielded by stream_response(allow_reset=True) when text already streamed this turn turns
+# out to be preamble to a tool call; the consumer should discard the text received so far
+STREAM_RESET = object()
+
+# USD list prices per million (input, output) tokens, by model id prefix (longest match wins).
+# Models not listed are logged without a cost estimate.
+MODEL_PRICES_PER_MTOK = {
+    "claude-opus-4": (15.00, 75.00),
+    "claude-opus-4-5": (5.00, 25.00),
+    "claude-sonnet-4": (3.00, 15.00),
+    "claude-haiku-4-5": (1.00, 5.00),
+    "claude-3-7-sonnet": (3.00, 15.00),
+    "claude-3-5-sonnet": (3.00, 15.00),
+    "claude-3-5-haiku": (0.80, 4.00),
+    "claude-3-haiku": (0.25, 1.25),
+}
+# Cache writes (5 min TTL) and reads are priced off the input rate
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.10
+
+
+def model_prices(model: str) -> Optional[Tuple[float, float]]:
+    """(input, output) USD per million tokens for model, or None if its prices are unknown"""
+    prefixes = [prefix for prefix in MODEL_PRICES_PER_MTOK if model.startswith(prefix)]
+    return MODEL_PRICES_PER_MTOK[max(prefixes, key=len)] if prefixes else None
+
+
+def usage_cost(model: str, input_tokens: int, output_tokens: int,
+               cache_read_input_tokens: int = 0, cache_creation_input_tokens: int = 0) -> Optional[float]:
+    """Estimated USD cost of one API call from its usage counts, or None for an unpriced model"""
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    input_cost, output_cost = prices
+    input_units = (input_tokens
+                   + cache_creation_input_tokens * CACHE_WRITE_MULTIPLIER
+                   + cache_read_input_tokens * CACHE_READ_MULTIPLIER)
+    return (input_units * input_cost + output_tokens * output_cost) / 1_000_000
+
+
+@functools.lru_cache(maxsize=None)
+def _shared_client(api_key: str) -> anthropic.AsyncAnthropic:
+    """Return the process-wide AsyncAnthropic client for an API key.
+
+    All AIGenerator instances share one pooled HTTP/2 connection pool, so TLS
+    handshakes and keep-alive connections are amortized across requests.
+    """
+    return anthropic.AsyncAnthropic(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=60,
+        ),
+    )
 
 class AIGenerator:
-    """Handles interactions with Anthropic's Claude API for generating responses"""
+    """
+    Handles interactions with Anthropic's Claude API for generating responses.
+
+    Build one per process and share it: the AsyncAnthropic client is shared and the
+    caches are only touched from the event loop. The generator keeps no per-request
+    state itself, but tools run through the tool_manager given to each call, so
+    concurrent callers must pass one that does not share per-request results such
+    as search sources (RAGSystem passes a ToolManager.for_request() view).
+    """
 
     MAX_TOOL_ROUNDS = 2
 
+    # Prompt for condensing older conversation turns
+    SUMMARY_PROMPT = """Condense the following dialogue between a user and a course materials assistant into a brief summary.
+Preserve facts the user stated about themselves, their goals, and which courses and lessons were discussed.
+Output only the summary."""
+    SUMMARY_MAX_TOKENS = 300
+
+    # Message Batches API limits and polling cadence
+    MAX_BATCH_REQUESTS = 10000
+    BATCH_POLL_INTERVAL = 30  # seconds
+
     # Static system prompt to avoid rebuilding on each call
     SYSTEM_PROMPT = """ You are an AI assistant specialized in course materials and educational content with access to tools for course information.
 
@@ -38,9 +127,26 @@ All responses must be:
 Provide only the direct answer to what was asked.
 """
     
-    def __init__(self, api_key: str, model: str):
-        self.client = anthropic.Anthropic(api_key=api_key)
+    def __init__(self, api_key: str, model: str,
+                 response_cache_size: int = 1024,
+                 embedding_function=None,
+                 semantic_cache_threshold: float = 0.08,
+                 semantic_cache_size: int = 10000,
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.client = _shared_client(api_key)
+        if rate_limiter is not None:
+            # Throttle to the account's request/token budget instead of tripping 429s
+            self.client = RateLimitedAnthropic(self.client, rate_limiter)
         self.model = model
+
+        # Final answers for identical inputs; safe to reuse because temperature is 0
+        self.response_cache = ResponseCache(response_cache_size)
+
+        # Optional tier for paraphrased first-turn queries, enabled when an embedding function is given
+        self.semantic_cache = (
+            SemanticCache(embedding_function, semantic_cache_threshold, semantic_cache_size)
+            if embedding_function is not None else None
+        )
         
         # Pre-build base API parameters
         self.base_params = {
@@ -48,84 +154,615 @@ Provide only the direct answer to what was asked.
             "temperature": 0,
             "max_tokens": 800
         }
+
+        # System prompt as a cacheable block, shared by every call so the cache key stays identical
+        self._system_blocks = [
+            {"type": "text", "text": self.SYSTEM_PROMPT, "cache_control": CACHE_CONTROL}
+        ]
+
+        # Frozen call template for the common no-history case: one dict copy per call
+        self._no_history_params = {**self.base_params, "system": self._system_blocks}
+
+        # (source tools, API-ready copy, cache-key JSON) for the last tool list seen
+        self._prepared_tools: Optional[Tuple[List, List, str]] = None
     
     def generate_response(self, query: str,
                          conversation_history: Optional[str] = None,
                          tools: Optional[List] = None,
-                         tool_manager=None) -> str:
+                         tool_manager=None,
+                         conversation_summary: Optional[str] = None,
+                         semantic_query: Optional[str] = None) -> str:
         """
-        Generate AI response with optional tool usage and conversation context.
+        Synchronous wrapper around agenerate_response() for callers outside an event loop.
+
+        Each call runs in a fresh event loop, so pooled connections are not reused
+        between calls; long-running servers should await agenerate_response() instead.
 
         Args:
             query: The user's question or request
             conversation_history: Previous messages for context
             tools: Available tools the AI can use
             tool_manager: Manager to execute tools
+            conversation_summary: Condensed summary of turns older than conversation_history
+            semantic_query: Text embedded for the semantic cache, defaulting to query; pass
+                the bare user question when query wraps it in a prompt template
 
         Returns:
             Generated response as string
         """
+        return asyncio.run(self.agenerate_response(
+            query,
+            conversation_history=conversation_history,
+            tools=tools,
+            tool_manager=tool_manager,
+            conversation_summary=conversation_summary,
+            semantic_query=semantic_query
+        ))
+
+    async def agenerate_response(self, query: str,
+                                 conversation_history: Optional[str] = None,
+                                 tools: Optional[List] = None,
+                                 tool_manager=None,
+                                 conversation_summary: Optional[str] = None,
+                                 semantic_query: Optional[str] = None) -> str:
+        """
+        Generate AI response with optional tool usage and conversation context.
+
+        Args:
+            query: The user's question or request
+            conversation_history: Previous messages for context
+            tools: Available tools the AI can use
+            tool_manager: Manager to execute tools
+            conversation_summary: Condensed summary of turns older than conversation_history
+            semantic_query: Text embedded for the semantic cache, defaulting to query; pass
+                the bare user question when query wraps it in a prompt template
 
-        # Build system content efficiently - avoid string ops when possible
-        system_content = (
-            f"{self.SYSTEM_PROMPT}\n\nPrevious conversation:\n{conversation_history}"
-            if conversation_history
-            else self.SYSTEM_PROMPT
+        Returns:
+            Generated response as string
+        """
+        tools, tools_json = self._prepare_tools(tools)
+        cached, cache_entry = await self._lookup_cache(
+            query, conversation_history, conversation_summary, tools_json, semantic_query
         )
+        if cached is not None:
+            return cached
+
+        # Static prompt stays in the cached prefix; history goes in its own uncached block
+        system_content = self._build_system(conversation_history, conversation_summary)
 
         messages = [{"role": "user", "content": query}]
 
-        # Initial API call
-        api_params = {
-            **self.base_params,
-            "messages": messages,
-            "system": system_content
-        }
-        if tools:
-            api_params["tools"] = tools
-            api_params["tool_choice"] = {"type": "auto"}
+        # Run the tool call Claude is most likely to make while waiting for its first response
+        speculation = self._start_speculation(query, tools, tool_manager)
 
-        response = self.client.messages.create(**api_params)
+        # Initial API call
+        response = await self.client.messages.create(
+            **self._call_params(messages, system_content, tools)
+        )
+        self._record_usage(response, 0)
 
         # Tool-use loop
+        used_tools = False
         for round_num in range(self.MAX_TOOL_ROUNDS):
             if response.stop_reason != "tool_use" or not tool_manager:
                 break
+            used_tools = True
+            await self._run_tool_round(response, messages, tool_manager, speculation)
+            speculation = None
+
+            response = await self.client.messages.create(
+                **self._call_params(messages, system_content, tools, self._tool_choice(round_num))
+            )
+            self._record_usage(response, round_num + 1)
+
+        self._discard_speculation(speculation)
+
+        text = self._extract_text(response)
+
+        # Tool results can change between calls, so only tool-free answers are cached
+        if not used_tools:
+            self._store_cache(cache_entry, text)
+        return text
+
+    async def stream_response(self, query: str,
+                              conversation_history: Optional[str] = None,
+                              tools: Optional[List] = None,
+                              tool_manager=None,
+                              conversation_summary: Optional[str] = None,
+                              semantic_query: Optional[str] = None,
+                              allow_reset: bool = False) -> AsyncIterator[Any]:
+        """
+        Stream the AI response as text deltas, running the same tool-use loop as agenerate_response().
+
+        Only the final turn's text makes up the answer, matching agenerate_response(). With
+        allow_reset, every turn is streamed delta by delta and STREAM_RESET is yielded as
+        soon as a turn starts a tool_use block, so the consumer can discard that turn's
+        preamble. Without it, a turn that may call tools is buffered and yielded (as one
+        chunk) only once it turns out to be the answer.
+
+        Args:
+            query: The user's question or request
+            conversation_history: Previous messages for context
+            tools: Available tools the AI can use
+            tool_manager: Manager to execute tools
+            conversation_summary: Condensed summary of turns older than conversation_history
+            semantic_query: Text embedded for the semantic cache, defaulting to query; pass
+                the bare user question when query wraps it in a prompt template
+            allow_reset: Whether the consumer handles STREAM_RESET
+
+        Yields:
+            Text deltas of the response, and STREAM_RESET when allow_reset is set
+        """
+        tools, tools_json = self._prepare_tools(tools)
+        cached, cache_entry = await self._lookup_cache(
+            query, conversation_history, conversation_summary, tools_json, semantic_query
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        system_content = self._build_system(conversation_history, conversation_summary)
+
+        messages = [{"role": "user", "content": query}]
+        params = self._call_params(messages, system_content, tools)
+        speculation = self._start_speculation(query, tools, tool_manager)
+
+        used_tools = False
+        for round_num in range(self.MAX_TOOL_ROUNDS + 1):
+            # The last round runs with tool_choice none, so its text is always the answer
+            may_use_tools = bool(tools and tool_manager) and round_num < self.MAX_TOOL_ROUNDS
+            buffer = may_use_tools and not allow_reset
+            buffered = []
+            streamed = calling_tool = False
+            async with self.client.messages.stream(**params) as stream:
+                async for event in stream:
+                    if (may_use_tools and event.type == "content_block_start"
+                            and event.content_block.type == "tool_use"):
+                        if streamed and not calling_tool:
+                            yield STREAM_RESET
+                        calling_tool = True
+                    elif event.type == "text" and not calling_tool:
+                        if buffer:
+                            buffered.append(event.text)  # Could be preamble to a tool call
+                        else:
+                            streamed = True
+                            yield event.text
+                response = await stream.get_final_message()
+            self._record_usage(response, round_num)
+
+            if (round_num == self.MAX_TOOL_ROUNDS
+                    or response.stop_reason != "tool_use" or not tool_manager):
+                if buffered:
+                    yield "".join(buffered)
+                break
+            used_tools = True
+            await self._run_tool_round(response, messages, tool_manager, speculation)
+            speculation = None
+
+            params = self._call_params(messages, system_content, tools, self._tool_choice(round_num))
+
+        self._discard_speculation(speculation)
 
-            # Append assistant's tool_use response
-            messages.append({"role": "assistant", "content": response.content})
-
-            # Execute all tool_use blocks, collect results
-            tool_results = []
-            for block in response.content:
-                if block.type == "tool_use":
-                    result = tool_manager.execute_tool(block.name, **block.input)
-                    tool_results.append({
-                        "type": "tool_result",
-                        "tool_use_id": block.id,
-                        "content": result
-                    })
-            messages.append({"role": "user", "content": tool_results})
-
-            # Build follow-up params
-            follow_up_params = {
+        if not used_tools:
+            self._store_cache(cache_entry, self._extract_text(response))
+
+    async def summarize_history(self, history: str, previous_summary: Optional[str] = None) -> str:
+        """
+        Condense conversation turns into a short summary that preserves user facts.
+
+        Args:
+            history: Formatted turns to condense
+            previous_summary: Existing summary of even earlier turns, folded into the result
+
+        Returns:
+            Summary text
+        """
+        dialogue = (
+            f"Earlier summary:\n{previous_summary}\n\nLater dialogue:\n{history}"
+            if previous_summary
+            else history
+        )
+        response = await self.client.messages.create(**{
+            **self.base_params,
+            "max_tokens": self.SUMMARY_MAX_TOKENS,
+            "system": self.SUMMARY_PROMPT,
+            "messages": [{"role": "user", "content": dialogue}]
+        })
+        self._record_usage(response, 0)
+        return self._extract_text(response)
+
+    def generate_batch(self, queries: List[str],
+                       poll_interval: float = BATCH_POLL_INTERVAL) -> List[Optional[str]]:
+        """Synchronous wrapper around agenerate_batch() for scripts and bulk jobs."""
+        return asyncio.run(self.agenerate_batch(queries, poll_interval))
+
+    async def agenerate_batch(self, queries: List[str],
+                              poll_interval: float = BATCH_POLL_INTERVAL) -> List[Optional[str]]:
+        """
+        Answer independent queries through the Message Batches API at half the per-token cost.
+
+        Intended for non-interactive workloads: batches can take minutes to hours, and
+        each request is a single turn without tools or conversation history.
+
+        Args:
+            queries: The questions to answer
+            poll_interval: Seconds to wait between batch status checks
+
+        Returns:
+            Answers in the same order as queries; None where a request did not succeed
+        """
+        answers: List[Optional[str]] = [None] * len(queries)
+        await asyncio.gather(*[
+            self._run_batch(queries, start, answers, poll_interval)
+            for start in range(0, len(queries), self.MAX_BATCH_REQUESTS)
+        ])
+        return answers
+
+    async def _run_batch(self, queries: List[str], start: int,
+                         answers: List[Optional[str]], poll_interval: float):
+        """Submit one batch of up to MAX_BATCH_REQUESTS queries and fill in their answers."""
+        requests = [
+            {
+                "custom_id": f"q{index}",
+                "params": {**self._no_history_params, "messages": [{"role": "user", "content": query}]}
+            }
+            for index, query in enumerate(queries[start:start + self.MAX_BATCH_REQUESTS], start)
+        ]
+        batch = await self.client.messages.batches.create(requests=requests)
+        while batch.processing_status != "ended":
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+
+        # Results arrive in arbitrary order; custom_id maps each back to its query
+        async for entry in await self.client.messages.batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                answers[int(entry.custom_id[1:])] = self._extract_text(entry.result.message)
+            else:
+                logger.warning("batch %s request %s %s", batch.id, entry.custom_id, entry.result.type)
+
+    async def _lookup_cache(self, query: str,
+                            conversation_history: Optional[str],
+                            conversation_summary: Optional[str],
+                            tools_json: str,
+                            semantic_query: Optional[str] = None) -> Tuple[Optional[str], Tuple]:
+        """
+        Check the exact and semantic response caches.
+
+        The semantic tier embeds semantic_query (default query): a shared prompt template
+        around short questions would pull their embeddings together and cause false hits.
+
+        Returns:
+            Tuple of (cached answer or None, entry to pass to _store_cache on a miss)
+        """
+        # Identical inputs that previously finished without tools return the stored answer
+        context = "\n\n".join(filter(None, [conversation_summary, conversation_history]))
+        cache_key = self.response_cache.make_key(
+            self.model, self.SYSTEM_PROMPT, query, context, tools_json
+        )
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached, ()
+
+        # Semantic lookup only without history, so answers never leak across conversations
+        query_embedding = semantic_context = None
+        if self.semantic_cache is not None and not context:
+            semantic_context = self.response_cache.make_key(self.model, self.SYSTEM_PROMPT, "", None, tools_json)
+            query_embedding = await asyncio.to_thread(self.semantic_cache.embed, semantic_query or query)
+            cached = self.semantic_cache.lookup(query_embedding, semantic_context)
+
+        return cached, (cache_key, query_embedding, semantic_context)
+
+    def _store_cache(self, cache_entry: Tuple, text: str):
+        """Store a tool-free answer in the exact and (when enabled) semantic caches."""
+        cache_key, query_embedding, semantic_context = cache_entry
+        self.response_cache.put(cache_key, text)
+        if query_embedding is not None:
+            self.semantic_cache.add(query_embedding, semantic_context, text)
+
+    def _call_params(self, messages: List[Dict[str, Any]],
+                     system_content: List[Dict[str, Any]],
+                     tools: Optional[List],
+                     tool_choice: Dict[str, str] = TOOL_CHOICE_AUTO) -> Dict[str, Any]:
+        """Build messages.create() parameters for one round."""
+        if system_content is self._system_blocks:
+            params = {**self._no_history_params, "messages": messages}
+        else:
+            params = {
                 **self.base_params,
                 "messages": messages,
                 "system": system_content
             }
+        if tools:
+            params["tools"] = tools
+            params["tool_choice"] = tool_choice
+        return params
 
-            # Include tools only if more rounds remain
-            if round_num < self.MAX_TOOL_ROUNDS - 1 and tools:
-                follow_up_params["tools"] = tools
-                follow_up_params["tool_choice"] = {"type": "auto"}
+    def _tool_choice(self, round_num: int) -> Dict[str, str]:
+        """
+        Tool choice for the follow-up after tool round round_num.
 
-            response = self.client.messages.create(**follow_up_params)
+        The final follow-up keeps the tool definitions so the cached prefix still
+        matches, but forbids further tool calls so Claude answers directly.
+        """
+        return TOOL_CHOICE_AUTO if round_num < self.MAX_TOOL_ROUNDS - 1 else TOOL_CHOICE_NONE
 
-        return self._extract_text(response)
+    async def _run_tool_round(self, response, messages: List[Dict[str, Any]], tool_manager,
+                              speculation: Optional[asyncio.Task] = None):
+        """Append the assistant's tool_use turn and the matching tool results to messages."""
+        messages.append({"role": "assistant", "content": response.content})
+
+        # Execute all tool_use blocks concurrently; gather preserves order for tool_use_id pairing
+        tool_blocks = [block for block in response.content if block.type == "tool_use"]
+        # Only the prediction is awaited here; the speculative call is awaited by the block it matches
+        speculated = await speculation if speculation is not None else None
+        if speculated is not None and not any(
+                speculated[:2] == (block.name, block.input) for block in tool_blocks):
+            speculated[2].cancel()  # Wrong guess: the real calls don't wait for it
+        results = await asyncio.gather(*[
+            self._execute_tool(tool_manager, block, speculated) for block in tool_blocks
+        ])
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": block.id, "content": result}
+            for block, result in zip(tool_blocks, results)
+        ]})
+
+    @staticmethod
+    async def _execute_tool(tool_manager, block,
+                            speculated: Optional[Tuple[str, Dict[str, Any], asyncio.Task]] = None) -> str:
+        """Run one tool_use block in a worker thread, reusing the speculative call if it matches."""
+        if speculated is not None and speculated[:2] == (block.name, block.input):
+            try:
+                return await speculated[2]
+            except Exception as e:
+                # A failed guess just means the real call runs after Claude's response
+                logger.debug("Speculative tool call failed: %s", e)
+        return await asyncio.to_thread(tool_manager.execute_tool, block.name, **block.input)
+
+    @classmethod
+    def _start_speculation(cls, query: str, tools: Optional[List],
+                           tool_manager) -> Optional[asyncio.Task]:
+        """Start predicting and executing the likely first tool call alongside the first API call."""
+        if not tools or not tool_manager:
+            return None
+        return asyncio.create_task(cls._speculate(query, tool_manager))
+
+    @staticmethod
+    async def _speculate(query: str, tool_manager) -> Optional[Tuple[str, Dict[str, Any], asyncio.Task]]:
+        """Return (tool_name, tool_input, running call) for the predicted call, or None if there is none."""
+        try:
+            prediction = await asyncio.to_thread(tool_manager.predict_tool_call, query)
+        except Exception as e:
+            logger.debug("Tool call prediction failed: %s", e)
+            return None
+        if prediction is None:
+            return None
+        tool_name, tool_input = prediction
+        call = asyncio.create_task(asyncio.to_thread(tool_manager.execute_tool, tool_name, **tool_input))
+        # Retrieve the outcome so an unused failed guess isn't reported as an unhandled error
+        call.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return tool_name, tool_input, call
+
+    @staticmethod
+    def _discard_speculation(speculation: Optional[asyncio.Task]):
+        """Cancel a speculation that no tool round consumed, including its started call."""
+        if speculation is None:
+            return
+        if not speculation.done():
+            speculation.cancel()
+        elif not speculation.cancelled() and speculation.result() is not None:
+            speculation.result()[2].cancel()
+
+    def _build_system(self, conversation_history: Optional[str],
+                      conversation_summary: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Build system content blocks: [SYSTEM_PROMPT (cached), summary (cached), recent turns].
+
+        The summary changes only when history is condensed, so it extends the cached
+        prefix per session; recent turns change every exchange and stay uncached.
+        """
+        if not conversation_history and not conversation_summary:
+            return self._system_blocks
+        blocks = list(self._system_blocks)
+        if conversation_summary:
+            blocks.append({
+                "type": "text",
+                "text": f"Summary of earlier conversation:\n{conversation_summary}",
+                "cache_control": CACHE_CONTROL
+            })
+        if conversation_history:
+            blocks.append({"type": "text", "text": f"Previous conversation:\n{conversation_history}"})
+        return blocks
+
+    def _prepare_tools(self, tools: Optional[List]) -> Tuple[Optional[List], str]:
+        """
+        Return (tools with a cache breakpoint, their cache-key JSON) for the given definitions.
+
+        A fixed registry passes the same list every call (ToolManager.get_tool_definitions),
+        so the result is memoized on identity and reused instead of rebuilt per request.
+        """
+        if not tools:
+            return None, ResponseCache.serialize_tools(None)
+        prepared = self._prepared_tools
+        if prepared is None or prepared[0] is not tools:
+            prepared = (tools, self._with_cache_breakpoint(tools), ResponseCache.serialize_tools(tools))
+            self._prepared_tools = prepared
+        return prepared[1], prepared[2]
+
+    @staticmethod
+    def _with_cache_breakpoint(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Return a copy of tools with cache_control on the last definition (caller's list is untouched)."""
+        return [*tools[:-1], {**tools[-1], "cache_control": CACHE_CONTROL}]
+
+    def _record_usage(self, response, round_num: int):
+        """
+        Log token usage, prompt cache hits/writes and estimated cost for a single API call.
+
+        The fields are also attached to the log record as extra["usage"] for structured
+        handlers; a drop in cache_read_input_tokens means the cached prefix stopped matching.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        # Cache fields are None when the request had no cache breakpoints
+        fields = {
+            name: int(getattr(usage, name, None) or 0)
+            for name in ("input_tokens", "output_tokens",
+                         "cache_read_input_tokens", "cache_creation_input_tokens")
+        }
+        cost = usage_cost(self.model, **fields)
+        fields["cost_usd"] = round(cost, 6) if cost is not None else None
+        logger.info(
+            "anthropic usage model=%s round=%d input_tokens=%d output_tokens=%d "
+            "cache_read_input_tokens=%d cache_creation_input_tokens=%d cost_usd=%s",
+            self.model, round_num, fields["input_tokens"], fields["output_tokens"],
+            fields["cache_read_input_tokens"], fields["cache_creation_input_tokens"],
+            f"{cost:.6f}" if cost is not None else "unknown",
+            extra={"usage": {"model": self.model, "round": round_num, **fields}},
+        )
 
     def _extract_text(self, response):
         """Extract text from a response that may contain mixed content blocks."""
-        for block in response.content:
-            if block.type == "text":
-                return block.text
-        return response.content[0].text
\ No newline at end of file
+        text = next((block.text for block in response.content if block.type == "text"), None)
+        # Fallback evaluated lazily: content[0] may be a tool_use block without .text
+        return text if text is not None else response.content[0].text
+
+
+class BatchingAIGenerator(AIGenerator):
+    """
+    AIGenerator that coalesces concurrent tool-free, history-free queries into one API call.
+
+    Queries arriving within max_wait_ms of each other (up to max_batch_size) are sent as a
+    single multi-question request and the JSON answers are split back out, so the cached
+    system prompt and the request count are amortized across callers. Queries with tools
+    or conversation context are not batched and go through AIGenerator unchanged.
+    """
+
+    MULTI_TASK_PROMPT = """You will receive a JSON array of independent questions, each with an "id".
+Answer each question on its own, exactly as you would if it were asked alone.
+Respond with only a JSON array of objects {"id": <question id>, "answer": <answer text>}, one per question."""
+
+    def __init__(self, *args, max_batch_size: int = 8, max_wait_ms: float = 25, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._batch_tasks = set()  # Strong refs to in-flight batch calls
+
+        # Shared system prompt stays first so the multi-task block extends its cached prefix
+        self._multi_task_system = [
+            *self._system_blocks, {"type": "text", "text": self.MULTI_TASK_PROMPT}
+        ]
+
+    async def agenerate_response(self, query: str,
+                                 conversation_history: Optional[str] = None,
+                                 tools: Optional[List] = None,
+                                 tool_manager=None,
+                                 conversation_summary: Optional[str] = None,
+                                 semantic_query: Optional[str] = None) -> str:
+        """Generate a response, batching it with concurrent queries when it has no tools or context."""
+        if tools or conversation_history or conversation_summary:
+            return await super().agenerate_response(
+                query, conversation_history, tools, tool_manager, conversation_summary, semantic_query
+            )
+
+        cached, cache_entry = await self._lookup_cache(
+            query, None, None, self._prepare_tools(None)[1], semantic_query
+        )
+        if cached is not None:
+            return cached
+
+        future = asyncio.get_running_loop().create_future()
+        await self._ensure_queue().put((query, future))
+        text = await future
+        self._store_cache(cache_entry, text)
+        return text
+
+    def _ensure_queue(self) -> asyncio.Queue:
+        """Return the pending-query queue, (re)starting its drain task on the running loop."""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._drain(self._queue))
+        return self._queue
+
+    async def _drain(self, queue: asyncio.Queue):
+        """Collect up to max_batch_size queries or until max_wait passes, then answer them together."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Keep collecting the next batch while this one is in flight
+            task = loop.create_task(self._answer_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _answer_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        """Answer a batch of queries and resolve each caller's future."""
+        queries = [query for query, _ in batch]
+        try:
+            if len(queries) == 1:
+                answers = [await self._answer_one(queries[0])]
+            else:
+                answers = await self._answer_many(queries)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), answer in zip(batch, answers):
+            if not future.done():
+                future.set_result(answer)
+
+    async def _answer_one(self, query: str) -> str:
+        """Answer a single query with a plain tool-free call."""
+        response = await self.client.messages.create(
+            **self._call_params([{"role": "user", "content": query}], self._system_blocks, None)
+        )
+        self._record_usage(response, 0)
+        return self._extract_text(response)
+
+    async def _answer_many(self, queries: List[str]) -> List[str]:
+        """Answer several queries in one multi-task call; unparsed answers are retried one by one."""
+        questions = [{"id": index, "question": query} for index, query in enumerate(queries)]
+        params = self._call_params(
+            [{"role": "user", "content": json.dumps(questions)}], self._multi_task_system, None
+        )
+        params["max_tokens"] = self.base_params["max_tokens"] * len(queries)
+        response = await self.client.messages.create(**params)
+        self._record_usage(response, 0)
+
+        answers = self._parse_answers(self._extract_text(response), len(queries))
+        missing = [index for index, answer in enumerate(answers) if answer is None]
+        if missing:
+            logger.warning("multi-task response missing %d of %d answers", len(missing), len(queries))
+            retried = await asyncio.gather(*[self._answer_one(queries[index]) for index in missing])
+            for index, answer in zip(missing, retried):
+                answers[index] = answer
+        return answers
+
+    @staticmethod
+    def _parse_answers(text: str, count: int) -> List[Optional[str]]:
+        """Map a JSON [{"id", "answer"}] reply back to question order; None where absent or malformed."""
+        answers: List[Optional[str]] = [None] * count
+        # Tolerate prose or code fences around the array
+        start, end = text.find("["), text.rfind("]")
+        try:
+            items = json.loads(text[start:end + 1]) if start != -1 else []
+        except json.JSONDecodeError:
+            return answers
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            index, answer = item.get("id"), item.get("answer")
+            if isinstance(index, int) and 0 <= index < count and isinstance(answer, str):
+                answers[index] = answer
+        return answers
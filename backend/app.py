@@ -1,17 +1,30 @@
 import warnings
 warnings.filterwarnings("ignore", message="resource_tracker: There appear to be.*")
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
+import json
+import logging
 import os
 
 from config import config
 from rag_system import RAGSystem
 
+# uvicorn configures only the uvicorn.* loggers, so without a handler here the
+# generator's per-call token usage and prompt-cache records would be dropped
+ai_logger = logging.getLogger("ai_generator")
+if not ai_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(levelname)s:     %(name)s: %(message)s"))
+    ai_logger.addHandler(_handler)
+    ai_logger.setLevel(config.AI_LOG_LEVEL)
+    ai_logger.propagate = False  # Don't double-log if the root logger is configured too
+
 # Initialize FastAPI app
 app = FastAPI(title="Course Materials RAG System", root_path="")
 
@@ -31,8 +44,15 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-# Initialize RAG system
-rag_system = RAGSystem(config)
+async def get_rag_system(request: Request) -> RAGSystem:
+    """
+    Return the process-wide RAG system built at startup.
+
+    Its AIGenerator and pooled Anthropic client are shared by every request, so
+    clients, TLS contexts and prompt/response caches are never rebuilt per request.
+    Being async, FastAPI calls it on the event loop instead of in the threadpool.
+    """
+    return request.app.state.rag_system
 
 # Pydantic models for request/response
 class QueryRequest(BaseModel):
@@ -59,7 +79,7 @@ class CourseStats(BaseModel):
 # API Endpoints
 
 @app.post("/api/query", response_model=QueryResponse)
-async def query_documents(request: QueryRequest):
+async def query_documents(request: QueryRequest, rag_system: RAGSystem = Depends(get_rag_system)):
     """Process a query and return response with sources"""
     try:
         # Create session if not provided
@@ -68,7 +88,7 @@ async def query_documents(request: QueryRequest):
             session_id = rag_system.session_manager.create_session()
         
         # Process query using RAG system
-        answer, sources = rag_system.query(request.query, session_id)
+        answer, sources = await rag_system.aquery(request.query, session_id)
         
         return QueryResponse(
             answer=answer,
@@ -78,8 +98,27 @@ async def query_documents(request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/query/stream")
+async def stream_query_documents(request: QueryRequest, rag_system: RAGSystem = Depends(get_rag_system)):
+    """Process a query, streaming the answer as newline-delimited JSON events"""
+    session_id = request.session_id
+    if not session_id:
+        session_id = rag_system.session_manager.create_session()
+
+    async def events():
+        try:
+            async for event in rag_system.astream_query(request.query, session_id):
+                if event["type"] == "done":
+                    event = {**event, "session_id": session_id}
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            # Headers are already sent, so errors are reported in-band
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.get("/api/courses", response_model=CourseStats)
-async def get_course_stats():
+async def get_course_stats(rag_system: RAGSystem = Depends(get_rag_system)):
     """Get course analytics and statistics"""
     try:
         analytics = rag_system.get_course_analytics()
@@ -92,12 +131,13 @@ async def get_course_stats():
 
 @app.on_event("startup")
 async def startup_event():
-    """Load initial documents on startup"""
+    """Build the shared RAG system and load initial documents on startup"""
+    app.state.rag_system = RAGSystem(config)
     docs_path = "../docs"
     if os.path.exists(docs_path):
         print("Loading initial documents...")
         try:
-            courses, chunks = rag_system.add_course_folder(docs_path, clear_existing=False)
+            courses, chunks = app.state.rag_system.add_course_folder(docs_path, clear_existing=False)
             print(f"Loaded {courses} courses with {chunks} chunks")
         except Exception as e:
             print(f"Error loading documents: {e}")
@@ -20,6 +20,20 @@ class Config:
     CHUNK_OVERLAP: int = 100     # Characters to overlap between chunks
     MAX_RESULTS: int = 5         # Maximum search results to return
     MAX_HISTORY: int = 2         # Number of conversation messages to remember
+    HISTORY_TOKEN_BUDGET: int = 2000  # Summarize older turns once history exceeds this
+    
+    # Response cache settings
+    RESPONSE_CACHE_SIZE: int = 1024  # Max cached answers for identical queries (0 disables)
+    SEMANTIC_CACHE_THRESHOLD: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.08"))  # Max cosine distance for a paraphrase hit
+    SEMANTIC_CACHE_SIZE: int = 10000  # Max cached answers matched by query embedding (0 disables)
+    
+    # Anthropic rate limits (set to your account tier; 0 leaves a limit off)
+    RATE_LIMIT_REQUESTS_PER_MINUTE: float = float(os.getenv("RATE_LIMIT_REQUESTS_PER_MINUTE", "0"))
+    RATE_LIMIT_TOKENS_PER_MINUTE: float = float(os.getenv("RATE_LIMIT_TOKENS_PER_MINUTE", "0"))
+    MAX_CONCURRENT_REQUESTS: int = int(os.getenv("MAX_CONCURRENT_REQUESTS", "10"))  # In-flight API calls
+    
+    # Level for the AI generator's per-call usage/cost log (uvicorn only configures its own loggers)
+    AI_LOG_LEVEL: str = os.getenv("AI_LOG_LEVEL", "INFO")
     
     # Database paths
     CHROMA_PATH: str = "./chroma_db"  # ChromaDB storage location
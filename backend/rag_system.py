@@ -1,8 +1,10 @@
-from typing import List, Tuple, Optional, Dict
+from typing import AsyncIterator, List, Tuple, Optional, Dict
+import asyncio
 import os
 from document_processor import DocumentProcessor
 from vector_store import VectorStore
-from ai_generator import AIGenerator
+from ai_generator import AIGenerator, STREAM_RESET
+from rate_limiter import RateLimiter
 from session_manager import SessionManager
 from search_tools import ToolManager, CourseSearchTool, CourseOutlineTool
 from models import Course, Lesson, CourseChunk
@@ -16,8 +18,21 @@ class RAGSystem:
         # Initialize core components
         self.document_processor = DocumentProcessor(config.CHUNK_SIZE, config.CHUNK_OVERLAP)
         self.vector_store = VectorStore(config.CHROMA_PATH, config.EMBEDDING_MODEL, config.MAX_RESULTS)
-        self.ai_generator = AIGenerator(config.ANTHROPIC_API_KEY, config.ANTHROPIC_MODEL)
+        self.ai_generator = AIGenerator(
+            config.ANTHROPIC_API_KEY,
+            config.ANTHROPIC_MODEL,
+            response_cache_size=config.RESPONSE_CACHE_SIZE,
+            embedding_function=self.vector_store.embedding_function,
+            semantic_cache_threshold=config.SEMANTIC_CACHE_THRESHOLD,
+            semantic_cache_size=config.SEMANTIC_CACHE_SIZE,
+            rate_limiter=RateLimiter(
+                config.RATE_LIMIT_REQUESTS_PER_MINUTE,
+                config.RATE_LIMIT_TOKENS_PER_MINUTE,
+                config.MAX_CONCURRENT_REQUESTS
+            )
+        )
         self.session_manager = SessionManager(config.MAX_HISTORY)
+        self._compactions: Dict[str, asyncio.Task] = {}  # In-flight history compaction per session
         
         # Initialize search tools
         self.tool_manager = ToolManager()
@@ -102,6 +117,30 @@ class RAGSystem:
         return total_courses, total_chunks
     
     def query(self, query: str, session_id: Optional[str] = None) -> Tuple[str, List[str]]:
+        """
+        Synchronous wrapper around aquery() for callers outside an event loop.
+        
+        History compaction runs before returning, since a background task would be
+        cancelled when this call's event loop closes.
+        
+        Args:
+            query: User's question
+            session_id: Optional session ID for conversation context
+            
+        Returns:
+            Tuple of (response, sources list - empty for tool-based approach)
+        """
+        return asyncio.run(self._aquery_and_compact(query, session_id))
+    
+    async def _aquery_and_compact(self, query: str, session_id: Optional[str]) -> Tuple[str, List[str]]:
+        """Run aquery(), then wait for the history compaction it scheduled, if any"""
+        result = await self.aquery(query, session_id)
+        compaction = self._compactions.get(session_id)
+        if compaction is not None:
+            await compaction
+        return result
+    
+    async def aquery(self, query: str, session_id: Optional[str] = None) -> Tuple[str, List[str]]:
         """
         Process a user query using the RAG system with tool-based search.
         
@@ -116,30 +155,109 @@ class RAGSystem:
         prompt = f"""Answer this question about course materials: {query}"""
         
         # Get conversation history if session exists
-        history = None
+        history = summary = None
         if session_id:
             history = self.session_manager.get_conversation_history(session_id)
+            summary = self.session_manager.get_summary(session_id)
         
-        # Generate response using AI with tools
-        response = self.ai_generator.generate_response(
+        # Generate response using AI with tools; sources are collected per request
+        request_tools = self.tool_manager.for_request()
+        response = await self.ai_generator.agenerate_response(
             query=prompt,
             conversation_history=history,
             tools=self.tool_manager.get_tool_definitions(),
-            tool_manager=self.tool_manager
+            tool_manager=request_tools,
+            conversation_summary=summary,
+            semantic_query=query
         )
         
-        # Get sources from the search tool
-        sources = self.tool_manager.get_last_sources()
-
-        # Reset sources after retrieving them
-        self.tool_manager.reset_sources()
+        # Return response with sources from this request's tool searches
+        self._record_exchange(query, session_id, response)
+        return response, request_tools.get_last_sources()
+    
+    async def astream_query(self, query: str, session_id: Optional[str] = None) -> AsyncIterator[Dict]:
+        """
+        Process a user query like aquery(), streaming the response as it is generated.
         
-        # Update conversation history
+        Args:
+            query: User's question
+            session_id: Optional session ID for conversation context
+            
+        Yields:
+            {"type": "delta", "text": ...} events, then one {"type": "done", "sources": [...]} event;
+            {"type": "reset"} means the deltas so far were preamble to a tool call and are void
+        """
+        prompt = f"""Answer this question about course materials: {query}"""
+        
+        history = summary = None
+        if session_id:
+            history = self.session_manager.get_conversation_history(session_id)
+            summary = self.session_manager.get_summary(session_id)
+        
+        chunks = []
+        request_tools = self.tool_manager.for_request()
+        async for text in self.ai_generator.stream_response(
+            query=prompt,
+            conversation_history=history,
+            tools=self.tool_manager.get_tool_definitions(),
+            tool_manager=request_tools,
+            conversation_summary=summary,
+            semantic_query=query,
+            allow_reset=True
+        ):
+            if text is STREAM_RESET:
+                chunks.clear()  # Keep the preamble out of the recorded history too
+                yield {"type": "reset"}
+                continue
+            chunks.append(text)
+            yield {"type": "delta", "text": text}
+        
+        self._record_exchange(query, session_id, "".join(chunks))
+        yield {"type": "done", "sources": request_tools.get_last_sources()}
+    
+    def _record_exchange(self, query: str, session_id: Optional[str], response: str):
+        """Record the exchange in the session history and compact it if it has grown too long"""
         if session_id:
             self.session_manager.add_exchange(session_id, query, response)
+            self._schedule_history_compaction(session_id)
+    
+    def _schedule_history_compaction(self, session_id: str):
+        """
+        Summarize in the background the turns trimmed from the history window, and
+        all but the latest exchange once history exceeds the token budget.
+        """
+        if session_id in self._compactions:
+            return  # Turns added meanwhile are picked up by the next exchange's compaction
+        if self.session_manager.estimate_history_tokens(session_id) > self.config.HISTORY_TOKEN_BUDGET:
+            keep_recent = 2
+        elif self.session_manager.has_trimmed_messages(session_id):
+            keep_recent = None
+        else:
+            return
+        task = asyncio.create_task(self.compact_history(session_id, keep_recent))
+        # Also a strong ref, so the pending task isn't GC'd
+        self._compactions[session_id] = task
+        task.add_done_callback(lambda _: self._compactions.pop(session_id, None))
+    
+    async def compact_history(self, session_id: str, keep_recent: Optional[int] = 2):
+        """
+        Fold trimmed turns, and window messages older than keep_recent, into the session summary.
         
-        # Return response with sources from tool searches
-        return response, sources
+        Keeps the system prompt prefix stable for prompt caching and caps the
+        number of history tokens sent with every query.
+        """
+        older = self.session_manager.messages_to_summarize(session_id, keep_recent)
+        if not older:
+            return
+        try:
+            summary = await self.ai_generator.summarize_history(
+                self.session_manager.format_messages(older),
+                self.session_manager.get_summary(session_id)
+            )
+        except Exception as e:
+            print(f"Error summarizing history for {session_id}: {e}")
+            return
+        self.session_manager.apply_summary(session_id, summary, older)
     
     def get_course_analytics(self) -> Dict:
         """Get analytics about the course catalog"""
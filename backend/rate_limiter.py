@@ -0,0 +1,137 @@
+import asyncio
+import json
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+
+def estimate_tokens(params: Dict[str, Any]) -> int:
+    """Rough token cost of a messages request: ~4 characters per prompt token plus max output"""
+    prompt = json.dumps(
+        [params.get("system"), params.get("messages"), params.get("tools")],
+        default=str
+    )
+    return len(prompt) // 4 + params.get("max_tokens", 0)
+
+
+def usage_tokens(usage) -> Optional[int]:
+    """Tokens a finished call counts against the limit, or None if the response has no usage"""
+    if usage is None:
+        return None
+    # Cache reads don't count toward input-token rate limits, so they are left out
+    return sum(
+        int(getattr(usage, name, None) or 0)
+        for name in ("input_tokens", "cache_creation_input_tokens", "output_tokens")
+    )
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for request and token budgets per minute, with a hard concurrency cap.
+
+    A per-minute limit of None (or 0) leaves that bucket unlimited.
+    """
+
+    def __init__(self,
+                 requests_per_minute: Optional[float] = 40,
+                 tokens_per_minute: Optional[float] = 16000,
+                 max_concurrency: int = 10):
+        self.max_requests_per_minute = float(requests_per_minute) if requests_per_minute else math.inf
+        self.max_tokens_per_minute = float(tokens_per_minute) if tokens_per_minute else math.inf
+        self.available_request_capacity = self.max_requests_per_minute
+        self.available_token_capacity = self.max_tokens_per_minute
+        self._last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @staticmethod
+    def _top_up(available: float, maximum: float, elapsed_minutes: float) -> float:
+        """Bucket level after refilling for elapsed_minutes, capped at its maximum"""
+        if maximum == math.inf:
+            return math.inf
+        return min(maximum, available + maximum * elapsed_minutes)
+
+    def _refill(self):
+        """Top up both buckets in proportion to the time since the last update"""
+        now = time.monotonic()
+        elapsed_minutes = (now - self._last_update) / 60
+        self._last_update = now
+        self.available_request_capacity = self._top_up(
+            self.available_request_capacity, self.max_requests_per_minute, elapsed_minutes
+        )
+        self.available_token_capacity = self._top_up(
+            self.available_token_capacity, self.max_tokens_per_minute, elapsed_minutes
+        )
+
+    async def acquire(self, tokens: int) -> int:
+        """Wait until one request and the given tokens are available, consume them and return the tokens charged"""
+        # A single request larger than the whole bucket would otherwise wait forever
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return tokens
+                # Sleep just long enough for the scarcer bucket to refill (only a finite one can be short)
+                request_wait = token_wait = 0
+                if self.available_request_capacity < 1:
+                    request_wait = (1 - self.available_request_capacity) / self.max_requests_per_minute
+                if self.available_token_capacity < tokens:
+                    token_wait = (tokens - self.available_token_capacity) / self.max_tokens_per_minute
+                await asyncio.sleep(max(request_wait, token_wait) * 60)
+
+    def settle(self, charged: int, actual: Optional[int]):
+        """Correct an up-front charge with the tokens a call actually used (refund or extra debit)"""
+        if actual is None or self.max_tokens_per_minute == math.inf:
+            return
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute, self.available_token_capacity + charged - actual
+        )
+
+    @asynccontextmanager
+    async def limit(self, tokens: int) -> AsyncIterator[int]:
+        """Hold a concurrency slot and the rate-limit budget for one API call; yields the tokens charged"""
+        async with self._semaphore:
+            yield await self.acquire(tokens)
+
+
+class RateLimitedAnthropic:
+    """Drop-in wrapper for AsyncAnthropic whose messages.create/stream wait for rate-limit capacity"""
+
+    def __init__(self, client, limiter: RateLimiter):
+        self._client = client
+        self.limiter = limiter
+        self.messages = _RateLimitedMessages(client.messages, limiter)
+
+    def __getattr__(self, name: str):
+        return getattr(self._client, name)
+
+
+class _RateLimitedMessages:
+    """messages resource proxy that routes create() and stream() through a RateLimiter"""
+
+    def __init__(self, messages, limiter: RateLimiter):
+        self._messages = messages
+        self._limiter = limiter
+
+    async def create(self, **params):
+        async with self._limiter.limit(estimate_tokens(params)) as charged:
+            response = await self._messages.create(**params)
+        # The estimate assumes max_tokens of output and no caching; true it up from usage
+        self._limiter.settle(charged, usage_tokens(getattr(response, "usage", None)))
+        return response
+
+    @asynccontextmanager
+    async def stream(self, **params):
+        async with self._limiter.limit(estimate_tokens(params)) as charged:
+            async with self._messages.stream(**params) as stream:
+                yield stream
+                message = await stream.get_final_message()
+        self._limiter.settle(charged, usage_tokens(getattr(message, "usage", None)))
+
+    def __getattr__(self, name: str):
+        # Everything else (e.g. batches, which has its own limits) passes straight through
+        return getattr(self._messages, name)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, List, Dict, Any, Optional, Tuple, Union
+
+
+class ResponseCache:
+    """Bounded LRU cache of final response text keyed by a digest of the request inputs"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+
+    @staticmethod
+    def serialize_tools(tools: Optional[List[Dict[str, Any]]]) -> str:
+        """Canonical JSON for tool definitions, so callers with a fixed registry can compute it once"""
+        return json.dumps(tools or [], sort_keys=True)
+
+    @staticmethod
+    def make_key(model: str,
+                 system_prompt: str,
+                 query: str,
+                 conversation_history: Optional[str] = None,
+                 tools: Union[List[Dict[str, Any]], str, None] = None) -> str:
+        """
+        Build a cache key from everything that determines a temperature-0 response.
+
+        tools may be the definitions themselves or their serialize_tools() output.
+        """
+        if not isinstance(tools, str):
+            tools = ResponseCache.serialize_tools(tools)
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (model, system_prompt, query, conversation_history or "", tools):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")  # Separator so adjacent parts can't run together
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, marking it most recently used"""
+        response = self._entries.get(key)
+        if response is not None:
+            self._entries.move_to_end(key)
+        return response
+
+    def put(self, key: str, response: str):
+        """Store a response, evicting the least recently used entry when full"""
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all cached responses"""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SemanticCache:
+    """Near-duplicate answer cache: matches new queries to prior ones by embedding cosine distance"""
+
+    def __init__(self,
+                 embedding_function: Callable[[List[str]], List[Any]],
+                 threshold: float = 0.08,
+                 max_entries: int = 10000):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # context key -> (unit-normalized query embeddings as rows, responses in row order)
+        self._partitions: Dict[str, Tuple[np.ndarray, List[str]]] = {}
+
+    def embed(self, query: str) -> np.ndarray:
+        """Embed a query as a unit vector so a dot product equals cosine similarity"""
+        vector = np.asarray(self.embedding_function([query])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding: np.ndarray, context: str) -> Optional[str]:
+        """Return the answer of the closest prior query in the same context, if within threshold"""
+        partition = self._partitions.get(context)
+        if partition is None:
+            return None
+        vectors, responses = partition
+        similarities = vectors @ embedding
+        best = int(np.argmax(similarities))
+        if 1.0 - similarities[best] < self.threshold:
+            return responses[best]
+        return None
+
+    def add(self, embedding: np.ndarray, context: str, response: str):
+        """Store an answer, dropping the oldest entry in the context when full"""
+        if self.max_entries <= 0:
+            return
+        vectors, responses = self._partitions.get(
+            context, (np.empty((0, embedding.shape[0]), dtype=np.float32), [])
+        )
+        vectors = np.vstack([vectors, embedding])
+        responses = responses + [response]
+        if len(responses) > self.max_entries:
+            vectors, responses = vectors[1:], responses[1:]
+        self._partitions[context] = (vectors, responses)
+
+    def clear(self):
+        """Remove all cached answers"""
+        self._partitions.clear()
+
+    def __len__(self) -> int:
+        return sum(len(responses) for _, responses in self._partitions.values())
@@ -1,4 +1,4 @@
-from typing import Dict, Any, Optional, Protocol
+from typing import Dict, Any, List, Optional, Protocol, Tuple
 from abc import ABC, abstractmethod
 from vector_store import VectorStore, SearchResults
 
@@ -15,6 +15,24 @@ class Tool(ABC):
     def execute(self, **kwargs) -> str:
         """Execute the tool with given parameters"""
         pass
+    
+    def execute_with_sources(self, **kwargs) -> Tuple[str, List[Dict[str, Any]]]:
+        """
+        Execute the tool and return (result, sources) without storing anything on the tool.
+        
+        Tools that report sources override this so concurrent requests sharing one
+        tool never read each other's sources; the default reports none.
+        """
+        return self.execute(**kwargs), []
+    
+    def predict_input(self, query: str) -> Optional[Dict[str, Any]]:
+        """
+        Guess the input Claude would call this tool with for query, or None.
+        
+        Only tools without side effects or sources should override this: a prediction
+        is executed speculatively and its result discarded if Claude chooses differently.
+        """
+        return None
 
 
 class CourseSearchTool(Tool):
@@ -51,7 +69,7 @@ class CourseSearchTool(Tool):
     
     def execute(self, query: str, course_name: Optional[str] = None, lesson_number: Optional[int] = None) -> str:
         """
-        Execute the search tool with given parameters.
+        Execute the search tool with given parameters, recording its sources in last_sources.
         
         Args:
             query: What to search for
@@ -61,7 +79,14 @@ class CourseSearchTool(Tool):
         Returns:
             Formatted search results or error message
         """
-        
+        result, sources = self.execute_with_sources(query, course_name, lesson_number)
+        if sources:
+            self.last_sources = sources
+        return result
+    
+    def execute_with_sources(self, query: str, course_name: Optional[str] = None,
+                             lesson_number: Optional[int] = None) -> Tuple[str, List[Dict[str, Any]]]:
+        """Run the search and return (formatted results or error message, sources for the UI)"""
         # Use the vector store's unified search interface
         results = self.store.search(
             query=query,
@@ -71,7 +96,7 @@ class CourseSearchTool(Tool):
         
         # Handle errors
         if results.error:
-            return results.error
+            return results.error, []
         
         # Handle empty results
         if results.is_empty():
@@ -80,13 +105,13 @@ class CourseSearchTool(Tool):
                 filter_info += f" in course '{course_name}'"
             if lesson_number:
                 filter_info += f" in lesson {lesson_number}"
-            return f"No relevant content found{filter_info}."
+            return f"No relevant content found{filter_info}.", []
         
         # Format and return results
         return self._format_results(results)
     
-    def _format_results(self, results: SearchResults) -> str:
-        """Format search results with course and lesson context"""
+    def _format_results(self, results: SearchResults) -> Tuple[str, List[Dict[str, Any]]]:
+        """Format search results with course and lesson context, returning them with their sources"""
         formatted = []
         sources = []  # Track sources for the UI
 
@@ -110,14 +135,14 @@ class CourseSearchTool(Tool):
 
             formatted.append(f"{header}\n{doc}")
 
-        # Store sources for retrieval
-        self.last_sources = sources
-
-        return "\n\n".join(formatted)
+        return "\n\n".join(formatted), sources
 
 class CourseOutlineTool(Tool):
     """Tool for retrieving course outline (title, link, and lesson list)"""
 
+    # Query words that almost always lead Claude to this tool
+    PREDICT_KEYWORDS = ("outline", "syllabus")
+
     def __init__(self, vector_store: VectorStore):
         self.store = vector_store
 
@@ -151,12 +176,23 @@ class CourseOutlineTool(Tool):
 
         return "\n".join(lines)
 
+    def predict_input(self, query: str) -> Optional[Dict[str, Any]]:
+        """Predict {"course_name": title} when query asks for the outline of a course it names in full"""
+        lowered = query.lower()
+        if not any(keyword in lowered for keyword in self.PREDICT_KEYWORDS):
+            return None
+        for title in self.store.get_existing_course_titles():
+            if title.lower() in lowered:
+                return {"course_name": title}
+        return None
+
 
 class ToolManager:
     """Manages available tools for the AI"""
     
     def __init__(self):
         self.tools = {}
+        self._tool_definitions = None  # Built once; tool definitions are static
     
     def register_tool(self, tool: Tool):
         """Register any tool that implements the Tool interface"""
@@ -165,11 +201,19 @@ class ToolManager:
         if not tool_name:
             raise ValueError("Tool must have a 'name' in its definition")
         self.tools[tool_name] = tool
+        self._tool_definitions = None
 
     
     def get_tool_definitions(self) -> list:
-        """Get all tool definitions for Anthropic tool calling"""
-        return [tool.get_tool_definition() for tool in self.tools.values()]
+        """
+        Get all tool definitions for Anthropic tool calling.
+        
+        The same list is returned until another tool is registered, so callers
+        can memoize work derived from it; it must not be mutated.
+        """
+        if self._tool_definitions is None:
+            self._tool_definitions = [tool.get_tool_definition() for tool in self.tools.values()]
+        return self._tool_definitions
     
     def execute_tool(self, tool_name: str, **kwargs) -> str:
         """Execute a tool by name with given parameters"""
@@ -178,6 +222,25 @@ class ToolManager:
         
         return self.tools[tool_name].execute(**kwargs)
     
+    def execute_tool_with_sources(self, tool_name: str, **kwargs) -> Tuple[str, List[Dict[str, Any]]]:
+        """Execute a tool by name, returning (result, sources) instead of storing the sources"""
+        if tool_name not in self.tools:
+            return f"Tool '{tool_name}' not found", []
+        
+        return self.tools[tool_name].execute_with_sources(**kwargs)
+    
+    def for_request(self) -> "RequestToolManager":
+        """Return a view of this manager that keeps the sources of one request's tool calls"""
+        return RequestToolManager(self)
+    
+    def predict_tool_call(self, query: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Return (tool_name, tool_input) of the first tool that predicts a call for query"""
+        for tool_name, tool in self.tools.items():
+            tool_input = tool.predict_input(query)
+            if tool_input is not None:
+                return tool_name, tool_input
+        return None
+    
     def get_last_sources(self) -> list:
         """Get sources from the last search operation"""
         # Check all tools for last_sources attribute
@@ -190,4 +253,32 @@ class ToolManager:
         """Reset sources from all tools that track sources"""
         for tool in self.tools.values():
             if hasattr(tool, 'last_sources'):
-                tool.last_sources = []
\ No newline at end of file
+                tool.last_sources = []
+
+
+class RequestToolManager:
+    """
+    Per-request view of a shared ToolManager.
+    
+    Requests run concurrently against the same tools, so sources are taken from
+    each call's return value and kept here rather than read back from the tools.
+    """
+    
+    def __init__(self, manager: ToolManager):
+        self.manager = manager
+        self.last_sources = []
+    
+    def execute_tool(self, tool_name: str, **kwargs) -> str:
+        """Execute a tool by name, keeping its sources if it found any"""
+        result, sources = self.manager.execute_tool_with_sources(tool_name, **kwargs)
+        if sources:
+            self.last_sources = sources
+        return result
+    
+    def predict_tool_call(self, query: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Return (tool_name, tool_input) of the first tool that predicts a call for query"""
+        return self.manager.predict_tool_call(query)
+    
+    def get_last_sources(self) -> list:
+        """Get sources from this request's last search"""
+        return self.last_sources
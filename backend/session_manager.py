@@ -13,6 +13,8 @@ class SessionManager:
     def __init__(self, max_history: int = 5):
         self.max_history = max_history
         self.sessions: Dict[str, List[Message]] = {}
+        self.summaries: Dict[str, str] = {}  # Condensed summary of turns removed from sessions
+        self.trimmed: Dict[str, List[Message]] = {}  # Turns dropped from the window, not yet summarized
         self.session_counter = 0
     
     def create_session(self) -> str:
@@ -30,9 +32,11 @@ class SessionManager:
         message = Message(role=role, content=content)
         self.sessions[session_id].append(message)
         
-        # Keep conversation history within limits
-        if len(self.sessions[session_id]) > self.max_history * 2:
-            self.sessions[session_id] = self.sessions[session_id][-self.max_history * 2:]
+        # Keep conversation history within limits, holding dropped turns until they are summarized
+        overflow = len(self.sessions[session_id]) - self.max_history * 2
+        if overflow > 0:
+            self.trimmed.setdefault(session_id, []).extend(self.sessions[session_id][:overflow])
+            self.sessions[session_id] = self.sessions[session_id][overflow:]
     
     def add_exchange(self, session_id: str, user_message: str, assistant_message: str):
         """Add a complete question-answer exchange"""
@@ -48,14 +52,57 @@ class SessionManager:
         if not messages:
             return None
         
-        # Format messages for context
-        formatted_messages = []
-        for msg in messages:
-            formatted_messages.append(f"{msg.role.title()}: {msg.content}")
-        
-        return "\n".join(formatted_messages)
+        return self.format_messages(messages)
+    
+    @staticmethod
+    def format_messages(messages: List[Message]) -> str:
+        """Format messages as "Role: content" lines for context"""
+        return "\n".join(f"{msg.role.title()}: {msg.content}" for msg in messages)
+    
+    def get_summary(self, session_id: Optional[str]) -> Optional[str]:
+        """Get the summary of earlier, already-condensed turns for a session"""
+        if not session_id:
+            return None
+        return self.summaries.get(session_id)
+    
+    def estimate_history_tokens(self, session_id: str) -> int:
+        """Approximate token count of a session's formatted history (~4 characters per token)"""
+        history = self.get_conversation_history(session_id)
+        return len(history) // 4 if history else 0
+    
+    def has_trimmed_messages(self, session_id: str) -> bool:
+        """Whether turns have dropped out of the history window without being summarized"""
+        return bool(self.trimmed.get(session_id))
+    
+    def messages_to_summarize(self, session_id: str, keep_recent: Optional[int] = 2) -> List[Message]:
+        """
+        Get the messages due for summarizing: trimmed turns, then window messages older
+        than the most recent keep_recent (none of the window when keep_recent is None)
+        """
+        messages = self.sessions.get(session_id, [])
+        if keep_recent is None:
+            older = []
+        else:
+            older = messages[:-keep_recent] if keep_recent else list(messages)
+        return self.trimmed.get(session_id, []) + older
+    
+    def apply_summary(self, session_id: str, summary: str, summarized: List[Message]):
+        """Replace the summarized messages with their summary"""
+        self.summaries[session_id] = summary
+        # Match by identity: messages may have been added or trimmed while summarizing
+        summarized_ids = {id(msg) for msg in summarized}
+        self.sessions[session_id] = [
+            msg for msg in self.sessions.get(session_id, []) if id(msg) not in summarized_ids
+        ]
+        remaining = [msg for msg in self.trimmed.get(session_id, []) if id(msg) not in summarized_ids]
+        if remaining:
+            self.trimmed[session_id] = remaining
+        else:
+            self.trimmed.pop(session_id, None)
     
     def clear_session(self, session_id: str):
         """Clear all messages from a session"""
         if session_id in self.sessions:
-            self.sessions[session_id] = []
\ No newline at end of file
+            self.sessions[session_id] = []
+        self.summaries.pop(session_id, None)
+        self.trimmed.pop(session_id, None)
\ No newline at end of file
@@ -1,41 +1,92 @@
-import sys
-import os
+import functools
+import json
+import anthropic
 import pytest
-from unittest.mock import MagicMock
-
-# Add backend to path so imports work
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import respx
+from types import MappingProxyType, SimpleNamespace
+from typing import Any, Mapping, NamedTuple, Tuple
+from unittest.mock import AsyncMock, MagicMock
 
+from ai_generator import _shared_client
 from vector_store import SearchResults
 
 
-@pytest.fixture
-def mock_vector_store():
-    """Mock VectorStore with all required methods."""
-    store = MagicMock()
-    store.search = MagicMock(return_value=SearchResults(
-        documents=[], metadata=[], distances=[]
-    ))
-    store.get_lesson_link = MagicMock(return_value=None)
-    store.get_course_outline = MagicMock(return_value=None)
-    return store
+class FakeVectorStore:
+    """Plain-Python VectorStore stand-in for the search-tool tests; records search() calls."""
 
+    def __init__(self):
+        self.reset()
 
-@pytest.fixture
+    def reset(self):
+        """Forget recorded calls and restore the default returns."""
+        self.search_calls = []
+        self.search_results = SearchResults(documents=[], metadata=[], distances=[])
+        self.lesson_link = None
+        self.course_outline = None
+        self.course_titles = []
+
+    def search(self, query, course_name=None, lesson_number=None):
+        self.search_calls.append(
+            {"query": query, "course_name": course_name, "lesson_number": lesson_number}
+        )
+        return self.search_results
+
+    def get_lesson_link(self, course_title, lesson_number):
+        return self.lesson_link
+
+    def get_course_outline(self, course_name):
+        return self.course_outline
+
+    def get_existing_course_titles(self):
+        return list(self.course_titles)
+
+
+@pytest.fixture(scope="session")
+def fake_vector_store():
+    """FakeVectorStore shared by the session; call reset() between tests."""
+    return FakeVectorStore()
+
+
+# Captured at import, before any test module patches anthropic.AsyncAnthropic
+REAL_ASYNC_ANTHROPIC = anthropic.AsyncAnthropic
+
+
+@pytest.fixture(scope="module")
 def mock_rag_system():
-    """Mock RAGSystem for API endpoint tests."""
+    """Mock RAGSystem for API endpoint tests, shared by a module; see reset_rag_system_mock()."""
     rag = MagicMock()
-    rag.query.return_value = ("This is a test answer.", ["Intro to AI - Lesson 1"])
+    reset_rag_system_mock(rag)
+    return rag
+
+
+def reset_rag_system_mock(rag):
+    """Clear calls and per-test overrides on a mock RAGSystem and install the default answers."""
+    rag.reset_mock(return_value=True, side_effect=True)
+    rag.aquery = AsyncMock(return_value=("This is a test answer.", ["Intro to AI - Lesson 1"]))
     rag.session_manager.create_session.return_value = "session_42"
     rag.get_course_analytics.return_value = {
         "total_courses": 3,
         "course_titles": ["Intro to AI", "Deep Learning", "NLP Basics"],
     }
-    return rag
+    rag.astream_query.side_effect = _stream_test_answer
+
+
+async def _stream_test_answer(query, session_id):
+    """Default astream_query() event sequence for the mock RAG system."""
+    yield {"type": "delta", "text": "This is "}
+    yield {"type": "delta", "text": "a test answer."}
+    yield {"type": "done", "sources": ["Intro to AI - Lesson 1"]}
+
 
+@pytest.fixture(scope="session")
+def sample_search_results():
+    """The cached SearchResults factory below, for tests to request as a fixture."""
+    return _search_results
 
-def sample_search_results(variant="success"):
-    """Factory returning SearchResults in different states.
+
+@functools.lru_cache(maxsize=None)
+def _search_results(variant="success"):
+    """Factory returning SearchResults in different states (cached; treat as read-only).
 
     Args:
         variant: "success", "empty", or "error"
@@ -59,30 +110,151 @@ def sample_search_results(variant="success"):
     raise ValueError(f"Unknown variant: {variant}")
 
 
+class FakeTextBlock(NamedTuple):
+    """Immutable text content block."""
+    text: str
+    type: str = "text"
+
+
+class FakeToolUseBlock(NamedTuple):
+    """Immutable tool_use content block."""
+    name: str
+    input: Mapping[str, Any]
+    id: str
+    type: str = "tool_use"
+
+
+class FakeMessage(NamedTuple):
+    """Immutable stand-in for an Anthropic Message; use _replace() to vary a shared one."""
+    stop_reason: str
+    content: Tuple[Any, ...]
+    usage: Any = None
+
+
 def mock_tool_use_response(tool_name="search_course_content", tool_input=None, tool_use_id="tool_123"):
-    """Factory for Anthropic API response with tool_use stop_reason."""
+    """Factory for Anthropic API response with tool_use stop_reason (cached, immutable)."""
     if tool_input is None:
         tool_input = {"query": "AI basics"}
+    return _tool_use_response(tool_name, tuple(sorted(tool_input.items())), tool_use_id)
 
-    tool_use_block = MagicMock()
-    tool_use_block.type = "tool_use"
-    tool_use_block.name = tool_name
-    tool_use_block.input = tool_input
-    tool_use_block.id = tool_use_id
 
-    response = MagicMock()
-    response.stop_reason = "tool_use"
-    response.content = [tool_use_block]
-    return response
+@functools.lru_cache(maxsize=128)
+def _tool_use_response(tool_name, tool_input_items, tool_use_id):
+    tool_use_block = FakeToolUseBlock(tool_name, MappingProxyType(dict(tool_input_items)), tool_use_id)
+    return FakeMessage(stop_reason="tool_use", content=(tool_use_block,))
 
 
+@functools.lru_cache(maxsize=128)
 def mock_text_response(text="Here is the answer about AI."):
-    """Factory for Anthropic API response with end_turn stop_reason."""
-    text_block = MagicMock()
-    text_block.type = "text"
-    text_block.text = text
-
-    response = MagicMock()
-    response.stop_reason = "end_turn"
-    response.content = [text_block]
-    return response
+    """Factory for Anthropic API response with end_turn stop_reason (cached, immutable)."""
+    return FakeMessage(stop_reason="end_turn", content=(FakeTextBlock(text),))
+
+
+@pytest.fixture(scope="module")
+def tool_resp_factory():
+    """mock_tool_use_response keyed by tool_use_id first, for building multi-round side_effects."""
+    def build(tool_use_id, tool_name="search_course_content", tool_input=None):
+        return mock_tool_use_response(tool_name=tool_name, tool_input=tool_input, tool_use_id=tool_use_id)
+    return build
+
+
+@pytest.fixture(scope="module")
+def canonical_final_response():
+    """Shared end_turn response for tests that only need the tool loop to finish."""
+    return mock_text_response("Final")
+
+
+class MockStream:
+    """Async context manager mimicking client.messages.stream() for a prebuilt response."""
+
+    def __init__(self, response, deltas=None):
+        self.response = response
+        if deltas is None:
+            deltas = [block.text for block in response.content if block.type == "text"]
+        self.deltas = deltas
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        """Stream events: the text deltas, then a content_block_start per tool_use block."""
+        for delta in self.deltas:
+            yield SimpleNamespace(type="text", text=delta)
+        for block in self.response.content:
+            if block.type == "tool_use":
+                yield SimpleNamespace(type="content_block_start", content_block=block)
+
+    async def get_final_message(self):
+        return self.response
+
+
+# ---------------------------------------------------------------------------
+# HTTP-level fakes: the real AsyncAnthropic client talking to a respx router
+# ---------------------------------------------------------------------------
+
+def text_message_json(text="Here is the answer about AI."):
+    """Messages API JSON body for an end_turn response (HTTP twin of mock_text_response)."""
+    return {
+        "id": "msg_text",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-test",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": 5},
+    }
+
+
+def tool_use_message_json(tool_name="search_course_content", tool_input=None, tool_use_id="tool_123"):
+    """Messages API JSON body for a tool_use response (HTTP twin of mock_tool_use_response)."""
+    return {
+        **text_message_json(),
+        "id": "msg_tool",
+        "content": [{
+            "type": "tool_use",
+            "id": tool_use_id,
+            "name": tool_name,
+            "input": {"query": "AI basics"} if tool_input is None else tool_input,
+        }],
+        "stop_reason": "tool_use",
+    }
+
+
+def sse_text_stream(deltas):
+    """Server-sent event body streaming a text-only message as the given deltas."""
+    message = {**text_message_json(""), "content": [], "stop_reason": None}
+    events = [
+        ("message_start", {"type": "message_start", "message": message}),
+        ("content_block_start", {"type": "content_block_start", "index": 0,
+                                 "content_block": {"type": "text", "text": ""}}),
+        *[("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                   "delta": {"type": "text_delta", "text": delta}})
+          for delta in deltas],
+        ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+        ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                           "usage": {"output_tokens": 5}}),
+        ("message_stop", {"type": "message_stop"}),
+    ]
+    return "".join(f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events)
+
+
+@pytest.fixture
+def anthropic_api(monkeypatch):
+    """respx router for api.anthropic.com; set side_effect on anthropic_api["messages"]."""
+    monkeypatch.delenv("ANTHROPIC_BASE_URL", raising=False)  # The SDK would send requests there instead
+    # Undo a module-scoped AsyncAnthropic mock for the duration of this test
+    monkeypatch.setattr(anthropic, "AsyncAnthropic", REAL_ASYNC_ANTHROPIC)
+    _shared_client.cache_clear()  # Build a real client inside the mock, not one from another test
+    with respx.mock(base_url="https://api.anthropic.com") as router:
+        router.post("/v1/messages", name="messages")
+        yield router
+    _shared_client.cache_clear()
+
+
+def request_json(route, index=-1):
+    """Decoded JSON body of a request recorded by a respx route."""
+    return json.loads(route.calls[index].request.content)
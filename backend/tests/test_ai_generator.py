@@ -1,36 +1,68 @@
-import sys
-import os
+import time
+import asyncio
+import threading
+import anthropic
+import httpx
 import pytest
-from unittest.mock import MagicMock, patch, call
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, call
 
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-sys.path.insert(0, os.path.dirname(__file__))
+from ai_generator import AIGenerator, BatchingAIGenerator, STREAM_RESET, _shared_client, usage_cost
+from rate_limiter import RateLimiter
+from conftest import (
+    mock_tool_use_response, mock_text_response, MockStream, FakeTextBlock,
+    text_message_json, tool_use_message_json, sse_text_stream, request_json,
+)
 
-from ai_generator import AIGenerator
-from conftest import mock_tool_use_response, mock_text_response
+pytestmark = pytest.mark.xdist_group("ai_generator")
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def mock_anthropic_client():
-    """Mock anthropic.Anthropic so client.messages.create() is controllable."""
-    with patch("ai_generator.anthropic.Anthropic") as MockAnthropic:
-        mock_client = MagicMock()
-        MockAnthropic.return_value = mock_client
+    """Mock anthropic.AsyncAnthropic so client.messages.create() is controllable."""
+    # Built once per module: the spec introspection is the costly part
+    mock_client = MagicMock(spec=anthropic.AsyncAnthropic)
+    mock_client.messages = MagicMock()
+    mock_client.messages.create = AsyncMock()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("ai_generator.anthropic.AsyncAnthropic", lambda **kwargs: mock_client)
+        _shared_client.cache_clear()
         yield mock_client
+    _shared_client.cache_clear()
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def generator(mock_anthropic_client):
     """AIGenerator with mocked Anthropic client."""
     return AIGenerator(api_key="test-key", model="claude-test")
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def mock_tool_manager():
     """Mock ToolManager."""
-    tm = MagicMock()
-    tm.execute_tool.return_value = "Tool result: AI basics explained"
-    return tm
+    return MagicMock()
+
+
+@pytest.fixture(autouse=True)
+def _reset_mocks(generator, mock_tool_manager, mock_anthropic_client):
+    """Give every test clean module-scoped mocks and an empty response cache."""
+    # Resetting messages covers create plus any stream/batches mocks a test installed
+    mock_anthropic_client.messages.reset_mock(return_value=True, side_effect=True)
+    mock_tool_manager.reset_mock(return_value=True, side_effect=True)
+    mock_tool_manager.execute_tool.return_value = "Tool result: AI basics explained"
+    mock_tool_manager.predict_tool_call.return_value = None
+    generator.response_cache.clear()
+
+
+class TestAIGeneratorClient:
+    """Tests for the shared, connection-pooled Anthropic client."""
+
+    def test_generators_share_one_client(self, mock_anthropic_client):
+        """AIGenerator instances with the same API key reuse a single pooled client."""
+        first = AIGenerator(api_key="test-key", model="claude-test")
+        second = AIGenerator(api_key="test-key", model="claude-other")
+
+        assert first.client is second.client is mock_anthropic_client
 
 
 class TestAIGeneratorDirectResponse:
@@ -49,82 +81,148 @@ class TestAIGeneratorDirectResponse:
 class TestAIGeneratorToolUse:
     """Tests for tool-calling flow."""
 
-    def test_tool_use_triggers_execution(self, generator, mock_anthropic_client, mock_tool_manager):
-        """When stop_reason='tool_use', calls tool_manager.execute_tool() with correct name/params."""
-        tool_response = mock_tool_use_response(
-            tool_name="search_course_content",
-            tool_input={"query": "AI basics"},
-            tool_use_id="tool_abc"
-        )
-        final_response = mock_text_response("Here is info about AI basics.")
-        mock_anthropic_client.messages.create.side_effect = [tool_response, final_response]
+    @pytest.fixture
+    def executed_tool_flow(self, generator, mock_anthropic_client, mock_tool_manager, request):
+        """Run one search_course_content round; indirect params override tool_use_id / tool_result."""
+        params = {
+            "tool_use_id": "tool_123",
+            "tool_result": "Tool result: AI basics explained",
+            **getattr(request, "param", {}),
+        }
+        mock_tool_manager.execute_tool.return_value = params["tool_result"]
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_tool_use_response(tool_use_id=params["tool_use_id"]),
+            mock_text_response("Final answer"),
+        ]
 
         result = generator.generate_response(
-            query="Tell me about AI",
+            query="Query",
             tools=[{"name": "search_course_content"}],
             tool_manager=mock_tool_manager
         )
-
-        mock_tool_manager.execute_tool.assert_called_once_with(
-            "search_course_content", query="AI basics"
+        return SimpleNamespace(
+            result=result, calls=mock_anthropic_client.messages.create.call_args_list, **params
         )
-        assert result == "Here is info about AI basics."
 
-    def test_tool_result_sent_back_to_claude(self, generator, mock_anthropic_client, mock_tool_manager):
-        """Follow-up API call includes tool_result message with correct tool_use_id and content."""
-        tool_response = mock_tool_use_response(tool_use_id="tool_xyz")
-        final_response = mock_text_response("Final answer")
-        mock_anthropic_client.messages.create.side_effect = [tool_response, final_response]
-
-        generator.generate_response(
-            query="Search query",
-            tools=[{"name": "search_course_content"}],
-            tool_manager=mock_tool_manager
-        )
-
-        # Check the second call's messages argument
-        second_call = mock_anthropic_client.messages.create.call_args_list[1]
-        messages = second_call.kwargs.get("messages") or second_call[1].get("messages")
+    def test_tool_use_triggers_execution(self, executed_tool_flow, mock_tool_manager):
+        """When stop_reason='tool_use', calls tool_manager.execute_tool() with correct name/params."""
+        assert mock_tool_manager.execute_tool.call_count == 1
+        assert mock_tool_manager.execute_tool.call_args == call("search_course_content", query="AI basics")
+        assert executed_tool_flow.result == "Final answer"
+
+    @pytest.mark.parametrize("executed_tool_flow", [
+        {"tool_use_id": "tool_xyz"},
+        {"tool_use_id": "tool_err", "tool_result": "Search error: n_results must be positive"},
+    ], ids=["result", "error_string"], indirect=True)
+    def test_tool_result_sent_back_to_claude(self, executed_tool_flow):
+        """Follow-up call carries a tool_result with the tool_use_id and content, error strings included."""
+        messages = executed_tool_flow.calls[1].kwargs["messages"]
         # Last message should contain tool_result
         tool_result_msg = messages[-1]
         assert tool_result_msg["role"] == "user"
         tool_result_content = tool_result_msg["content"][0]
         assert tool_result_content["type"] == "tool_result"
-        assert tool_result_content["tool_use_id"] == "tool_xyz"
-        assert tool_result_content["content"] == "Tool result: AI basics explained"
+        assert tool_result_content["tool_use_id"] == executed_tool_flow.tool_use_id
+        assert tool_result_content["content"] == executed_tool_flow.tool_result
 
-    def test_second_call_includes_tools(self, generator, mock_anthropic_client, mock_tool_manager):
+    def test_second_call_includes_tools(self, executed_tool_flow):
         """Second messages.create() call includes tools (allows a second tool round)."""
-        tool_response = mock_tool_use_response()
-        final_response = mock_text_response("Done")
-        mock_anthropic_client.messages.create.side_effect = [tool_response, final_response]
+        assert "tools" in executed_tool_flow.calls[1].kwargs
+
+    def test_parallel_tool_blocks_run_concurrently_in_order(self, generator, mock_anthropic_client, mock_tool_manager):
+        """Multiple tool_use blocks in one turn execute concurrently; results keep block order."""
+        slow_block = mock_tool_use_response(
+            tool_name="get_course_outline", tool_input={"course_name": "MCP"}, tool_use_id="tool_slow"
+        ).content[0]
+        fast_block = mock_tool_use_response(
+            tool_name="search_course_content", tool_input={"query": "AI"}, tool_use_id="tool_fast"
+        ).content[0]
+        tool_response = mock_tool_use_response()._replace(content=(slow_block, fast_block))
+        mock_anthropic_client.messages.create.side_effect = [tool_response, mock_text_response("Done")]
+
+        # Both calls must be in flight at once to pass the barrier; run one after the other, it breaks
+        both_running = threading.Barrier(2, timeout=5)
+        fast_done = threading.Event()
+
+        def execute_tool(name, **kwargs):
+            both_running.wait()
+            if name == "get_course_outline":
+                fast_done.wait(timeout=5)  # Finish last, so order can't come from completion
+            else:
+                fast_done.set()
+            return f"{name} result"
+        mock_tool_manager.execute_tool.side_effect = execute_tool
 
         generator.generate_response(
             query="Query",
-            tools=[{"name": "search_course_content"}],
+            tools=[{"name": "get_course_outline"}, {"name": "search_course_content"}],
             tool_manager=mock_tool_manager
         )
 
-        second_call_kwargs = mock_anthropic_client.messages.create.call_args_list[1].kwargs
-        assert "tools" in second_call_kwargs
+        tool_results = mock_anthropic_client.messages.create.call_args_list[1].kwargs["messages"][-1]["content"]
+        assert [r["tool_use_id"] for r in tool_results] == ["tool_slow", "tool_fast"]
+        assert [r["content"] for r in tool_results] == [
+            "get_course_outline result", "search_course_content result"
+        ]
+
+
+class TestAIGeneratorSpeculation:
+    """Tests for running the predicted tool call alongside the first API call."""
 
-    def test_tool_error_string_forwarded(self, generator, mock_anthropic_client, mock_tool_manager):
-        """When tool returns error string, it's passed to Claude as tool_result content."""
-        mock_tool_manager.execute_tool.return_value = "Search error: n_results must be positive"
-        tool_response = mock_tool_use_response(tool_use_id="tool_err")
-        final_response = mock_text_response("Sorry, search failed")
-        mock_anthropic_client.messages.create.side_effect = [tool_response, final_response]
+    def test_matching_prediction_reuses_result(self, generator, mock_anthropic_client, mock_tool_manager):
+        """When Claude calls the predicted tool with the predicted input, it is executed only once."""
+        mock_tool_manager.predict_tool_call.return_value = ("get_course_outline", {"course_name": "MCP"})
+        mock_tool_manager.execute_tool.return_value = "Outline"
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_tool_use_response("get_course_outline", {"course_name": "MCP"}),
+            mock_text_response("Done")
+        ]
 
         generator.generate_response(
-            query="Query",
-            tools=[{"name": "search_course_content"}],
-            tool_manager=mock_tool_manager
+            query="Outline of MCP", tools=[{"name": "get_course_outline"}], tool_manager=mock_tool_manager
+        )
+
+        mock_tool_manager.execute_tool.assert_called_once_with("get_course_outline", course_name="MCP")
+        tool_result = mock_anthropic_client.messages.create.call_args_list[1].kwargs["messages"][2]["content"][0]
+        assert tool_result["content"] == "Outline"
+
+    def test_mismatched_prediction_runs_real_call(self, generator, mock_anthropic_client, mock_tool_manager):
+        """When Claude chooses differently, the real call runs without waiting for the discarded guess."""
+        mock_tool_manager.predict_tool_call.return_value = ("get_course_outline", {"course_name": "MCP"})
+        guess_started, real_call_started = threading.Event(), threading.Event()
+        guess_saw_real_call = []
+
+        def execute_tool(name, **kwargs):
+            if name == "get_course_outline":
+                guess_started.set()
+                # Blocks until the real call starts; it would time out if that call waited for it
+                guess_saw_real_call.append(real_call_started.wait(timeout=5))
+            else:
+                real_call_started.set()
+            return f"{name} result"
+        mock_tool_manager.execute_tool.side_effect = execute_tool
+
+        responses = iter([mock_tool_use_response("search_course_content", {"query": "servers"}),
+                          mock_text_response("Done")])
+
+        async def create(**kwargs):
+            # Claude answers while the guess is still running
+            await asyncio.to_thread(guess_started.wait, 5)
+            return next(responses)
+        mock_anthropic_client.messages.create.side_effect = create
+
+        generator.generate_response(
+            query="Outline of MCP", tools=[{"name": "search_course_content"}], tool_manager=mock_tool_manager
         )
 
-        second_call = mock_anthropic_client.messages.create.call_args_list[1]
-        messages = second_call.kwargs.get("messages") or second_call[1].get("messages")
-        tool_result_content = messages[-1]["content"][0]
-        assert tool_result_content["content"] == "Search error: n_results must be positive"
+        # The guess and the real call run in separate threads, so either may be recorded first
+        calls = mock_tool_manager.execute_tool.call_args_list
+        assert len(calls) == 2
+        assert call("get_course_outline", course_name="MCP") in calls
+        assert call("search_course_content", query="servers") in calls
+        assert guess_saw_real_call == [True]
+        tool_result = mock_anthropic_client.messages.create.call_args_list[1].kwargs["messages"][2]["content"][0]
+        assert tool_result["content"] == "search_course_content result"
 
 
 class TestAIGeneratorSystemPrompt:
@@ -139,10 +237,13 @@ class TestAIGeneratorSystemPrompt:
             conversation_history="User: What is AI?\nAssistant: AI is..."
         )
 
-        call_kwargs = mock_anthropic_client.messages.create.call_args.kwargs
-        system = call_kwargs.get("system") or mock_anthropic_client.messages.create.call_args[1].get("system")
-        assert "Previous conversation:" in system
-        assert "What is AI?" in system
+        system = mock_anthropic_client.messages.create.call_args.kwargs.get("system")
+        # History is appended as a separate, uncached block after the cached SYSTEM_PROMPT
+        assert len(system) == 2
+        assert system[0]["text"] == AIGenerator.SYSTEM_PROMPT
+        assert "Previous conversation:" in system[1]["text"]
+        assert "What is AI?" in system[1]["text"]
+        assert "cache_control" not in system[1]
 
     def test_no_history_system_prompt(self, generator, mock_anthropic_client):
         """When conversation_history=None, system prompt is just SYSTEM_PROMPT."""
@@ -150,30 +251,446 @@ class TestAIGeneratorSystemPrompt:
 
         generator.generate_response(query="First question")
 
+        system = mock_anthropic_client.messages.create.call_args.kwargs.get("system")
+        assert system == [{
+            "type": "text",
+            "text": AIGenerator.SYSTEM_PROMPT,
+            "cache_control": {"type": "ephemeral"},
+        }]
+
+    def test_summary_block_cached_before_recent_history(self, generator, mock_anthropic_client):
+        """conversation_summary goes in a cached block between SYSTEM_PROMPT and the recent turns."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+
+        generator.generate_response(
+            query="Follow-up question",
+            conversation_history="User: And servers?\nAssistant: They expose tools.",
+            conversation_summary="User is learning MCP."
+        )
+
+        system = mock_anthropic_client.messages.create.call_args.kwargs["system"]
+        assert [block.get("cache_control") for block in system] == [
+            {"type": "ephemeral"}, {"type": "ephemeral"}, None
+        ]
+        assert "User is learning MCP." in system[1]["text"]
+        assert "And servers?" in system[2]["text"]
+
+    def test_summarize_history_folds_in_previous_summary(self, generator, mock_anthropic_client):
+        """summarize_history() sends older turns plus any earlier summary, with no tools."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Condensed")
+
+        summary = asyncio.run(generator.summarize_history(
+            "User: What is MCP?\nAssistant: A protocol.", previous_summary="User is a beginner."
+        ))
+
+        assert summary == "Condensed"
+        call_kwargs = mock_anthropic_client.messages.create.call_args.kwargs
+        assert call_kwargs["system"] == AIGenerator.SUMMARY_PROMPT
+        assert call_kwargs["max_tokens"] == AIGenerator.SUMMARY_MAX_TOKENS
+        assert "tools" not in call_kwargs
+        content = call_kwargs["messages"][0]["content"]
+        assert "User is a beginner." in content and "What is MCP?" in content
+
+
+class TestAIGeneratorPromptCaching:
+    """Tests for prompt-cache breakpoints on system prompt and tools."""
+
+    def test_last_tool_marked_for_caching(self, generator, mock_anthropic_client):
+        """Only the last tool definition carries cache_control; the caller's list is not mutated."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+        tools = [{"name": "get_course_outline"}, {"name": "search_course_content"}]
+
+        generator.generate_response(query="Question", tools=tools)
+
+        sent_tools = mock_anthropic_client.messages.create.call_args.kwargs["tools"]
+        assert "cache_control" not in sent_tools[0]
+        assert sent_tools[1] == {"name": "search_course_content", "cache_control": {"type": "ephemeral"}}
+        assert "cache_control" not in tools[1]
+
+    def test_system_blocks_identical_across_tool_rounds(self, generator, mock_anthropic_client, mock_tool_manager):
+        """Follow-up calls reuse the same system list so the cached prefix is byte-identical."""
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_tool_use_response(), mock_text_response("Done")
+        ]
+
+        generator.generate_response(
+            query="Query",
+            conversation_history="User: Hi\nAssistant: Hello",
+            tools=[{"name": "search_course_content"}],
+            tool_manager=mock_tool_manager
+        )
+
+        calls = mock_anthropic_client.messages.create.call_args_list
+        assert calls[0].kwargs["system"] is calls[1].kwargs["system"]
+
+    def test_prepared_tools_reused_for_same_registry(self, generator, mock_anthropic_client):
+        """The same tool list object is prepared once and sent as-is on later requests."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+        tools = [{"name": "search_course_content"}]
+
+        generator.generate_response(query="First", tools=tools)
+        generator.generate_response(query="Second", tools=tools)
+        generator.generate_response(query="Third", tools=[{"name": "search_course_content"}])
+
+        calls = mock_anthropic_client.messages.create.call_args_list
+        assert calls[0].kwargs["tools"] is calls[1].kwargs["tools"]
+        assert calls[2].kwargs["tools"] is not calls[1].kwargs["tools"]
+        assert calls[2].kwargs["tools"] == calls[1].kwargs["tools"]
+
+
+class TestAIGeneratorUsageLogging:
+    """Tests for per-call token usage and cost logging."""
+
+    def test_usage_and_cost_logged_per_call(self, generator, mock_anthropic_client, caplog, monkeypatch):
+        """Token counts, cache reads/writes and estimated cost are attached to the log record."""
+        monkeypatch.setattr(generator, "model", "claude-sonnet-4-20250514")
+        response = mock_text_response("Answer")._replace(usage=SimpleNamespace(
+            input_tokens=1000, output_tokens=200,
+            cache_read_input_tokens=10000, cache_creation_input_tokens=None
+        ))
+        mock_anthropic_client.messages.create.return_value = response
+
+        with caplog.at_level("INFO", logger="ai_generator"):
+            generator.generate_response(query="What is AI?")
+
+        usage = caplog.records[-1].usage
+        assert usage["cache_read_input_tokens"] == 10000
+        assert usage["cache_creation_input_tokens"] == 0
+        # 1000 input + 10000 reads at 0.1x = 2000 input units at $3/MTok, 200 output at $15/MTok
+        assert usage["cost_usd"] == pytest.approx(0.009)
+
+    def test_cost_priced_by_model(self):
+        """Prices follow the configured model; unlisted models get no estimate."""
+        assert usage_cost("claude-opus-4-1-20250805", 1_000_000, 0) == pytest.approx(15.00)
+        assert usage_cost("claude-opus-4-5-20251101", 1_000_000, 0) == pytest.approx(5.00)
+        assert usage_cost("claude-3-5-haiku-20241022", 0, 1_000_000) == pytest.approx(4.00)
+        assert usage_cost("claude-test", 1000, 200) is None
+
+
+class TestAIGeneratorResponseCache:
+    """Tests for the exact-match response cache."""
+
+    def test_identical_query_served_from_cache(self, generator, mock_anthropic_client):
+        """A repeated tool-free query returns the cached answer without calling the API again."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Cached answer")
+
+        first = generator.generate_response(query="What is AI?")
+        second = generator.generate_response(query="What is AI?")
+
+        assert first == second == "Cached answer"
+        mock_anthropic_client.messages.create.assert_called_once()
+
+    def test_history_changes_cache_key(self, generator, mock_anthropic_client):
+        """The same query with different conversation history is not a cache hit."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+
+        generator.generate_response(query="And then?")
+        generator.generate_response(query="And then?", conversation_history="User: Hi")
+
+        assert mock_anthropic_client.messages.create.call_count == 2
+
+    def test_tool_answers_not_cached(self, generator, mock_anthropic_client, mock_tool_manager):
+        """Answers that depended on tool results are always regenerated."""
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_tool_use_response(), mock_text_response("First"),
+            mock_tool_use_response(), mock_text_response("Second"),
+        ]
+        kwargs = dict(query="Query", tools=[{"name": "search_course_content"}], tool_manager=mock_tool_manager)
+
+        assert generator.generate_response(**kwargs) == "First"
+        assert generator.generate_response(**kwargs) == "Second"
+        assert len(generator.response_cache) == 0
+
+
+class TestAIGeneratorSemanticCache:
+    """Tests for the embedding-based semantic cache tier."""
+
+    EMBEDDINGS = {
+        "What is AI?": [1.0, 0.0, 0.0],
+        "Explain AI": [0.99, 0.05, 0.0],
+        "What is MCP?": [0.0, 1.0, 0.0],
+    }
+
+    @pytest.fixture
+    def semantic_generator(self, mock_anthropic_client):
+        return AIGenerator(
+            api_key="test-key",
+            model="claude-test",
+            embedding_function=lambda texts: [self.EMBEDDINGS[t] for t in texts],
+        )
+
+    def test_paraphrase_served_from_semantic_cache(self, semantic_generator, mock_anthropic_client):
+        """A query within the distance threshold of a cached one reuses its answer."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("AI is ...")
+
+        semantic_generator.generate_response(query="What is AI?")
+        result = semantic_generator.generate_response(query="Explain AI")
+
+        assert result == "AI is ..."
+        mock_anthropic_client.messages.create.assert_called_once()
+
+    def test_distant_query_misses(self, semantic_generator, mock_anthropic_client):
+        """An unrelated query is sent to the API."""
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_text_response("AI is ..."), mock_text_response("MCP is ...")
+        ]
+
+        semantic_generator.generate_response(query="What is AI?")
+        result = semantic_generator.generate_response(query="What is MCP?")
+
+        assert result == "MCP is ..."
+        assert mock_anthropic_client.messages.create.call_count == 2
+
+    def test_embeds_bare_question_inside_prompt_template(self, semantic_generator, mock_anthropic_client):
+        """With RAGSystem's prompt template, the bare question is embedded, not the shared prefix."""
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_text_response("AI is ..."), mock_text_response("MCP is ...")
+        ]
+
+        def ask(question):
+            # EMBEDDINGS has no entry for the templated text, so embedding it would fail
+            return semantic_generator.generate_response(
+                query=f"Answer this question about course materials: {question}",
+                semantic_query=question,
+            )
+
+        assert ask("What is AI?") == "AI is ..."
+        assert ask("What is MCP?") == "MCP is ..."
+        assert ask("Explain AI") == "AI is ..."
+        assert mock_anthropic_client.messages.create.call_count == 2
+
+    def test_skipped_with_conversation_history(self, semantic_generator, mock_anthropic_client):
+        """Queries with history neither read from nor write to the semantic cache."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+
+        semantic_generator.generate_response(query="What is AI?")
+        semantic_generator.generate_response(query="Explain AI", conversation_history="User: Hi")
+
+        assert mock_anthropic_client.messages.create.call_count == 2
+        assert len(semantic_generator.semantic_cache) == 1
+
+
+class TestAIGeneratorStreaming:
+    """Tests for stream_response()."""
+
+    @staticmethod
+    async def _collect(stream):
+        return [text async for text in stream]
+
+    def test_streams_text_deltas(self, generator, mock_anthropic_client):
+        """Direct answers are yielded delta by delta."""
+        mock_anthropic_client.messages.stream = MagicMock(return_value=MockStream(
+            mock_text_response("Hello world"), deltas=["Hello", " world"]
+        ))
+
+        chunks = asyncio.run(self._collect(generator.stream_response(query="Hi")))
+
+        assert chunks == ["Hello", " world"]
+        assert generator.response_cache.get(generator.response_cache.make_key(
+            "claude-test", AIGenerator.SYSTEM_PROMPT, "Hi"
+        )) == "Hello world"
+
+    def test_tool_round_then_streamed_answer(self, generator, mock_anthropic_client, mock_tool_manager):
+        """A tool_use turn is executed before the follow-up answer is streamed."""
+        mock_anthropic_client.messages.stream = MagicMock(side_effect=[
+            MockStream(mock_tool_use_response(tool_use_id="tool_s")),
+            MockStream(mock_text_response("Answer"), deltas=["Ans", "wer"]),
+        ])
+
+        chunks = asyncio.run(self._collect(generator.stream_response(
+            query="Query",
+            tools=[{"name": "search_course_content"}],
+            tool_manager=mock_tool_manager
+        )))
+
+        # The follow-up could still have called a tool, so it arrives once it is known to be the answer
+        assert chunks == ["Answer"]
+        mock_tool_manager.execute_tool.assert_called_once_with("search_course_content", query="AI basics")
+        follow_up = mock_anthropic_client.messages.stream.call_args_list[1].kwargs
+        assert follow_up["messages"][-1]["content"][0]["tool_use_id"] == "tool_s"
+
+    def test_tool_turn_preamble_is_not_streamed(self, generator, mock_anthropic_client, mock_tool_manager,
+                                                tool_resp_factory):
+        """Text before a tool_use block is dropped, so the stream matches agenerate_response()."""
+        tool_turn = tool_resp_factory("tool_p")
+        tool_turn = tool_turn._replace(content=(FakeTextBlock("Let me search."), *tool_turn.content))
+        final = mock_text_response("The answer.")
+        tools = [{"name": "search_course_content"}]
+        mock_anthropic_client.messages.stream = MagicMock(side_effect=[
+            MockStream(tool_turn, deltas=["Let me ", "search."]),
+            MockStream(final, deltas=["The ", "answer."]),
+        ])
+        mock_anthropic_client.messages.create.side_effect = [tool_turn, final]
+
+        chunks = asyncio.run(self._collect(generator.stream_response(
+            query="Query", tools=tools, tool_manager=mock_tool_manager
+        )))
+
+        assert chunks == ["The answer."]
+        assert "".join(chunks) == generator.generate_response(
+            query="Query", tools=tools, tool_manager=mock_tool_manager
+        )
+
+    def test_allow_reset_streams_tool_turns_and_voids_preamble(self, generator, mock_anthropic_client,
+                                                              mock_tool_manager, tool_resp_factory):
+        """With allow_reset, tool-enabled turns stream live and a tool_use block yields STREAM_RESET."""
+        tool_turn = tool_resp_factory("tool_r")
+        tool_turn = tool_turn._replace(content=(FakeTextBlock("Let me search."), *tool_turn.content))
+        mock_anthropic_client.messages.stream = MagicMock(side_effect=[
+            MockStream(tool_turn, deltas=["Let me ", "search."]),
+            MockStream(mock_text_response("The answer."), deltas=["The ", "answer."]),
+        ])
+
+        chunks = asyncio.run(self._collect(generator.stream_response(
+            query="Query", tools=[{"name": "search_course_content"}], tool_manager=mock_tool_manager,
+            allow_reset=True
+        )))
+
+        assert chunks == ["Let me ", "search.", STREAM_RESET, "The ", "answer."]
+
+
+class TestAIGeneratorBatch:
+    """Tests for Message Batches API submission."""
+
+    def test_batch_results_returned_in_query_order(self, generator, mock_anthropic_client):
+        """Polls until the batch ends and maps out-of-order results back by custom_id."""
+        batches = mock_anthropic_client.messages.batches
+        batches.create = AsyncMock(return_value=SimpleNamespace(id="batch_1", processing_status="in_progress"))
+        batches.retrieve = AsyncMock(return_value=SimpleNamespace(id="batch_1", processing_status="ended"))
+
+        async def results():
+            yield SimpleNamespace(custom_id="q1", result=SimpleNamespace(
+                type="succeeded", message=mock_text_response("Second answer")))
+            yield SimpleNamespace(custom_id="q2", result=SimpleNamespace(type="errored"))
+            yield SimpleNamespace(custom_id="q0", result=SimpleNamespace(
+                type="succeeded", message=mock_text_response("First answer")))
+        batches.results = AsyncMock(return_value=results())
+
+        answers = generator.generate_batch(["Q0", "Q1", "Q2"], poll_interval=0)
+
+        assert answers == ["First answer", "Second answer", None]
+        batches.retrieve.assert_awaited_once_with("batch_1")
+        requests = batches.create.call_args.kwargs["requests"]
+        assert [r["custom_id"] for r in requests] == ["q0", "q1", "q2"]
+        assert requests[0]["params"]["messages"] == [{"role": "user", "content": "Q0"}]
+        assert requests[0]["params"]["system"] == generator._system_blocks
+
+
+class TestBatchingAIGenerator:
+    """Tests for coalescing concurrent tool-free queries into one multi-task call."""
+
+    @pytest.fixture
+    def batching_generator(self, mock_anthropic_client):
+        return BatchingAIGenerator(api_key="test-key", model="claude-test", max_wait_ms=10)
+
+    @staticmethod
+    def _ask_concurrently(generator, queries):
+        async def ask():
+            return await asyncio.gather(*[generator.agenerate_response(query) for query in queries])
+        return asyncio.run(ask())
+
+    def test_concurrent_queries_share_one_call(self, batching_generator, mock_anthropic_client):
+        """Queries within the wait window go out as one request; answers are split back by id."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response(
+            '[{"id": 1, "answer": "MCP is a protocol."}, {"id": 0, "answer": "AI is ..."}]'
+        )
+
+        answers = self._ask_concurrently(batching_generator, ["What is AI?", "What is MCP?"])
+
+        assert answers == ["AI is ...", "MCP is a protocol."]
+        mock_anthropic_client.messages.create.assert_awaited_once()
+        call_kwargs = mock_anthropic_client.messages.create.call_args.kwargs
+        assert call_kwargs["system"][0] == batching_generator._system_blocks[0]
+        assert call_kwargs["max_tokens"] == 2 * batching_generator.base_params["max_tokens"]
+        assert "tools" not in call_kwargs
+
+    def test_missing_answer_retried_alone(self, batching_generator, mock_anthropic_client):
+        """A question the multi-task reply skipped is answered with its own call."""
+        mock_anthropic_client.messages.create.side_effect = [
+            mock_text_response('[{"id": 0, "answer": "AI is ..."}]'),
+            mock_text_response("MCP is a protocol."),
+        ]
+
+        answers = self._ask_concurrently(batching_generator, ["What is AI?", "What is MCP?"])
+
+        assert answers == ["AI is ...", "MCP is a protocol."]
+        retry = mock_anthropic_client.messages.create.call_args_list[1].kwargs
+        assert retry["messages"] == [{"role": "user", "content": "What is MCP?"}]
+
+    def test_tool_queries_not_batched(self, batching_generator, mock_anthropic_client):
+        """Queries with tools take the regular single-query path."""
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+
+        result = batching_generator.generate_response(query="Query", tools=[{"name": "search_course_content"}])
+
+        assert result == "Answer"
         call_kwargs = mock_anthropic_client.messages.create.call_args.kwargs
-        system = call_kwargs.get("system") or mock_anthropic_client.messages.create.call_args[1].get("system")
-        assert system == AIGenerator.SYSTEM_PROMPT
-        assert "Previous conversation:" not in system
+        assert call_kwargs["messages"] == [{"role": "user", "content": "Query"}]
+        assert call_kwargs["tool_choice"] == {"type": "auto"}
+
+
+class TestAIGeneratorRateLimiting:
+    """Tests for the token-bucket rate limiter around messages.create()."""
+
+    def test_calls_consume_limiter_budget(self, mock_anthropic_client):
+        """With a limiter, each API call consumes one request and its estimated tokens."""
+        limiter = RateLimiter(requests_per_minute=40, tokens_per_minute=16000)
+        generator = AIGenerator(api_key="test-key", model="claude-test", rate_limiter=limiter)
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")
+
+        result = generator.generate_response(query="What is AI?")
+
+        assert result == "Answer"
+        mock_anthropic_client.messages.create.assert_awaited_once()
+        assert limiter.available_request_capacity == pytest.approx(39, abs=0.01)
+        assert limiter.available_token_capacity < 16000 - generator.base_params["max_tokens"]
+
+    def test_charge_trued_up_from_usage(self, mock_anthropic_client):
+        """After a call, the estimate is replaced by the usage it reports; cache reads are free."""
+        limiter = RateLimiter(requests_per_minute=40, tokens_per_minute=16000)
+        generator = AIGenerator(api_key="test-key", model="claude-test", rate_limiter=limiter)
+        mock_anthropic_client.messages.create.return_value = mock_text_response("Answer")._replace(
+            usage=SimpleNamespace(input_tokens=300, output_tokens=50,
+                                  cache_read_input_tokens=2000, cache_creation_input_tokens=None)
+        )
+
+        generator.generate_response(query="What is AI?")
+
+        assert limiter.available_token_capacity == pytest.approx(16000 - 350, abs=1)
+
+    def test_unset_limits_never_wait(self):
+        """A limiter without per-minute limits only caps concurrency."""
+        limiter = RateLimiter(requests_per_minute=None, tokens_per_minute=0)
+
+        async def burst():
+            for _ in range(1000):
+                await limiter.acquire(100000)
+        start = time.perf_counter()
+        asyncio.run(burst())
+
+        assert time.perf_counter() - start < 0.5
+
+    def test_acquire_waits_for_refill(self):
+        """When the request bucket is empty, acquire() sleeps until it refills."""
+        limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=100000)
+        limiter.available_request_capacity = 0
+
+        start = time.perf_counter()
+        asyncio.run(limiter.acquire(10))
+
+        assert time.perf_counter() - start >= 0.09
 
 
 class TestAIGeneratorMultiRoundToolUse:
     """Tests for multi-round (sequential) tool calling."""
 
-    def test_two_sequential_tool_rounds(self, generator, mock_anthropic_client, mock_tool_manager):
+    def test_two_sequential_tool_rounds(self, generator, mock_anthropic_client, mock_tool_manager,
+                                        tool_resp_factory, canonical_final_response):
         """Two tool calls produce 3 API calls, 2 execute_tool calls, and return final text."""
-        tool_response_1 = mock_tool_use_response(
-            tool_name="get_course_outline",
-            tool_input={"course_name": "MCP"},
-            tool_use_id="tool_1"
-        )
-        tool_response_2 = mock_tool_use_response(
-            tool_name="search_course_content",
-            tool_input={"query": "topic X"},
-            tool_use_id="tool_2"
-        )
-        final_response = mock_text_response("Here is the combined answer.")
         mock_anthropic_client.messages.create.side_effect = [
-            tool_response_1, tool_response_2, final_response
+            tool_resp_factory("tool_1", "get_course_outline", {"course_name": "MCP"}),
+            tool_resp_factory("tool_2", "search_course_content", {"query": "topic X"}),
+            canonical_final_response,
         ]
         mock_tool_manager.execute_tool.side_effect = ["Outline result", "Search result"]
 
@@ -183,19 +700,18 @@ class TestAIGeneratorMultiRoundToolUse:
             tool_manager=mock_tool_manager
         )
 
-        assert result == "Here is the combined answer."
+        assert result == "Final"
         assert mock_anthropic_client.messages.create.call_count == 3
-        assert mock_tool_manager.execute_tool.call_count == 2
-        mock_tool_manager.execute_tool.assert_any_call("get_course_outline", course_name="MCP")
-        mock_tool_manager.execute_tool.assert_any_call("search_course_content", query="topic X")
-
-    def test_max_rounds_excludes_tools_on_final_call(self, generator, mock_anthropic_client, mock_tool_manager):
-        """1st and 2nd follow-up calls have tools, 3rd (final) call does NOT."""
-        tool_response_1 = mock_tool_use_response(tool_use_id="tool_1")
-        tool_response_2 = mock_tool_use_response(tool_use_id="tool_2")
-        final_response = mock_text_response("Final")
+        assert mock_tool_manager.execute_tool.call_args_list == [
+            call("get_course_outline", course_name="MCP"),
+            call("search_course_content", query="topic X"),
+        ]
+
+    def test_max_rounds_disables_tool_choice_on_final_call(self, generator, mock_anthropic_client, mock_tool_manager,
+                                                           tool_resp_factory, canonical_final_response):
+        """All calls send tools (keeps the cached prefix); only the 3rd (final) call sets tool_choice none."""
         mock_anthropic_client.messages.create.side_effect = [
-            tool_response_1, tool_response_2, final_response
+            tool_resp_factory("tool_1"), tool_resp_factory("tool_2"), canonical_final_response
         ]
         mock_tool_manager.execute_tool.side_effect = ["Result 1", "Result 2"]
 
@@ -206,18 +722,18 @@ class TestAIGeneratorMultiRoundToolUse:
         )
 
         calls = mock_anthropic_client.messages.create.call_args_list
-        # 1st call (initial): has tools
-        assert "tools" in calls[0].kwargs
-        # 2nd call (round 0 follow-up): has tools
-        assert "tools" in calls[1].kwargs
-        # 3rd call (round 1 follow-up): no tools
-        assert "tools" not in calls[2].kwargs
-
-    def test_early_termination_after_one_tool_round(self, generator, mock_anthropic_client, mock_tool_manager):
+        # 1st call (initial): tools, auto
+        assert calls[0].kwargs["tool_choice"] == {"type": "auto"}
+        # 2nd call (round 0 follow-up): tools, auto
+        assert calls[1].kwargs["tool_choice"] == {"type": "auto"}
+        # 3rd call (round 1 follow-up): same tools, but no further tool use allowed
+        assert calls[2].kwargs["tools"] == calls[0].kwargs["tools"]
+        assert calls[2].kwargs["tool_choice"] == {"type": "none"}
+
+    def test_early_termination_after_one_tool_round(self, generator, mock_anthropic_client, mock_tool_manager,
+                                                    tool_resp_factory, canonical_final_response):
         """When Claude returns end_turn after first tool use, only 2 API calls and 1 execute_tool."""
-        tool_response = mock_tool_use_response(tool_use_id="tool_1")
-        final_response = mock_text_response("Done after one round")
-        mock_anthropic_client.messages.create.side_effect = [tool_response, final_response]
+        mock_anthropic_client.messages.create.side_effect = [tool_resp_factory("tool_1"), canonical_final_response]
 
         result = generator.generate_response(
             query="Simple query",
@@ -225,24 +741,20 @@ class TestAIGeneratorMultiRoundToolUse:
             tool_manager=mock_tool_manager
         )
 
-        assert result == "Done after one round"
-        assert mock_anthropic_client.messages.create.call_count == 2
+        calls = mock_anthropic_client.messages.create.call_args_list
+        assert result == "Final"
+        assert len(calls) == 2
         assert mock_tool_manager.execute_tool.call_count == 1
         # 2nd call includes tools (round 0 < MAX_TOOL_ROUNDS - 1)
-        second_call_kwargs = mock_anthropic_client.messages.create.call_args_list[1].kwargs
-        assert "tools" in second_call_kwargs
+        assert "tools" in calls[1].kwargs
 
-    def test_messages_accumulate_across_rounds(self, generator, mock_anthropic_client, mock_tool_manager):
+    def test_messages_accumulate_across_rounds(self, generator, mock_anthropic_client, mock_tool_manager,
+                                               tool_resp_factory, canonical_final_response):
         """After 2 tool rounds, the 3rd call's messages has 5 entries."""
-        tool_response_1 = mock_tool_use_response(
-            tool_name="get_course_outline", tool_use_id="tool_A"
-        )
-        tool_response_2 = mock_tool_use_response(
-            tool_name="search_course_content", tool_use_id="tool_B"
-        )
-        final_response = mock_text_response("Final answer")
         mock_anthropic_client.messages.create.side_effect = [
-            tool_response_1, tool_response_2, final_response
+            tool_resp_factory("tool_A", "get_course_outline"),
+            tool_resp_factory("tool_B", "search_course_content"),
+            canonical_final_response,
         ]
         mock_tool_manager.execute_tool.side_effect = ["Outline data", "Content data"]
 
@@ -252,8 +764,8 @@ class TestAIGeneratorMultiRoundToolUse:
             tool_manager=mock_tool_manager
         )
 
-        third_call = mock_anthropic_client.messages.create.call_args_list[2]
-        messages = third_call.kwargs["messages"]
+        calls = mock_anthropic_client.messages.create.call_args_list
+        messages = calls[2].kwargs["messages"]
         assert len(messages) == 5
         # user, assistant(tool_A), user(result_A), assistant(tool_B), user(result_B)
         assert messages[0]["role"] == "user"
@@ -268,16 +780,74 @@ class TestAIGeneratorMultiRoundToolUse:
 
     def test_extract_text_from_mixed_content(self, generator):
         """_extract_text returns TextBlock text even when ToolUseBlock comes first."""
-        tool_block = MagicMock()
-        tool_block.type = "tool_use"
-        tool_block.text = None
-
-        text_block = MagicMock()
-        text_block.type = "text"
-        text_block.text = "The actual answer"
-
-        response = MagicMock()
-        response.content = [tool_block, text_block]
+        tool_block = SimpleNamespace(type="tool_use", text=None)
+        text_block = SimpleNamespace(type="text", text="The actual answer")
+        response = SimpleNamespace(content=[tool_block, text_block])
 
         result = generator._extract_text(response)
         assert result == "The actual answer"
+
+
+class TestAIGeneratorRequestBody:
+    """Tests that run the real SDK against a respx router and inspect the JSON sent."""
+
+    TOOLS = [
+        {"name": "get_course_outline", "description": "Outline", "input_schema": {"type": "object"}},
+        {"name": "search_course_content", "description": "Search", "input_schema": {"type": "object"}},
+    ]
+
+    @pytest.fixture
+    def http_generator(self, anthropic_api):
+        return AIGenerator(api_key="test-key", model="claude-test")
+
+    def test_cache_breakpoints_serialized(self, http_generator, anthropic_api):
+        """cache_control reaches the wire on the system block and only the last tool."""
+        anthropic_api["messages"].side_effect = [httpx.Response(200, json=text_message_json("Answer"))]
+
+        result = http_generator.generate_response(query="What is AI?", tools=self.TOOLS)
+
+        assert result == "Answer"
+        body = request_json(anthropic_api["messages"])
+        assert body["system"] == [{
+            "type": "text", "text": AIGenerator.SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"},
+        }]
+        assert "cache_control" not in body["tools"][0]
+        assert body["tools"][1]["cache_control"] == {"type": "ephemeral"}
+        assert body["tool_choice"] == {"type": "auto"}
+
+    def test_tool_round_trip_body(self, http_generator, anthropic_api, mock_tool_manager):
+        """The parsed tool_use block is re-sent as JSON and paired with its tool_result."""
+        anthropic_api["messages"].side_effect = [
+            httpx.Response(200, json=tool_use_message_json(tool_use_id="toolu_1")),
+            httpx.Response(200, json=text_message_json("Done")),
+        ]
+
+        result = http_generator.generate_response(
+            query="Query", tools=self.TOOLS, tool_manager=mock_tool_manager
+        )
+
+        assert result == "Done"
+        first, follow_up = request_json(anthropic_api["messages"], 0), request_json(anthropic_api["messages"], 1)
+        # Identical prefix on both rounds keeps the prompt cache warm
+        assert follow_up["system"] == first["system"]
+        assert follow_up["tools"] == first["tools"]
+        assert follow_up["messages"][1] == {"role": "assistant", "content": [{
+            "type": "tool_use", "id": "toolu_1", "name": "search_course_content", "input": {"query": "AI basics"},
+        }]}
+        assert follow_up["messages"][2] == {"role": "user", "content": [{
+            "type": "tool_result", "tool_use_id": "toolu_1", "content": "Tool result: AI basics explained",
+        }]}
+
+    def test_stream_request_and_deltas(self, http_generator, anthropic_api):
+        """stream_response() sends stream=true and yields the SSE text deltas."""
+        anthropic_api["messages"].side_effect = [httpx.Response(
+            200, text=sse_text_stream(["Hello", " world"]), headers={"content-type": "text/event-stream"}
+        )]
+
+        async def collect():
+            return [text async for text in http_generator.stream_response(query="Hi")]
+
+        assert asyncio.run(collect()) == ["Hello", " world"]
+        body = request_json(anthropic_api["messages"])
+        assert body["stream"] is True
+        assert body["system"][0]["cache_control"] == {"type": "ephemeral"}
@@ -5,16 +5,18 @@ importing app.py directly (which mounts static files from a path that doesn't
 exist in the test environment).
 """
 
-import sys
-import os
+import json
 import pytest
 from unittest.mock import MagicMock
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
 from fastapi.testclient import TestClient
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, List, Optional
 
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from conftest import reset_rag_system_mock
+
+pytestmark = pytest.mark.xdist_group("api")
 
 
 # ---------------------------------------------------------------------------
@@ -35,25 +37,47 @@ class CourseStats(BaseModel):
     course_titles: List[str]
 
 
-def create_test_app(mock_rag_system):
-    """Build a minimal FastAPI app wired to the given mock RAG system."""
+async def get_rag_system() -> Any:
+    """Placeholder dependency, async like app.py's; tests supply the mock via app.dependency_overrides."""
+    raise NotImplementedError
+
+
+def create_test_app():
+    """Build a minimal FastAPI app whose routes resolve the RAG system through get_rag_system."""
     app = FastAPI()
 
     @app.post("/api/query", response_model=QueryResponse)
-    async def query_documents(request: QueryRequest):
+    async def query_documents(request: QueryRequest, rag_system: Any = Depends(get_rag_system)):
         try:
             session_id = request.session_id
             if not session_id:
-                session_id = mock_rag_system.session_manager.create_session()
-            answer, sources = mock_rag_system.query(request.query, session_id)
+                session_id = rag_system.session_manager.create_session()
+            answer, sources = await rag_system.aquery(request.query, session_id)
             return QueryResponse(answer=answer, sources=sources, session_id=session_id)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    @app.post("/api/query/stream")
+    async def stream_query_documents(request: QueryRequest, rag_system: Any = Depends(get_rag_system)):
+        session_id = request.session_id
+        if not session_id:
+            session_id = rag_system.session_manager.create_session()
+
+        async def events():
+            try:
+                async for event in rag_system.astream_query(request.query, session_id):
+                    if event["type"] == "done":
+                        event = {**event, "session_id": session_id}
+                    yield json.dumps(event) + "\n"
+            except Exception as e:
+                yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+        return StreamingResponse(events(), media_type="application/x-ndjson")
+
     @app.get("/api/courses", response_model=CourseStats)
-    async def get_course_stats():
+    async def get_course_stats(rag_system: Any = Depends(get_rag_system)):
         try:
-            analytics = mock_rag_system.get_course_analytics()
+            analytics = rag_system.get_course_analytics()
             return CourseStats(
                 total_courses=analytics["total_courses"],
                 course_titles=analytics["course_titles"],
@@ -64,11 +88,28 @@ def create_test_app(mock_rag_system):
     return app
 
 
-@pytest.fixture
-def client(mock_rag_system):
-    """TestClient backed by a mock RAG system."""
-    app = create_test_app(mock_rag_system)
-    return TestClient(app)
+@pytest.fixture(scope="module")
+def app(mock_rag_system):
+    """The test app, built once per module, with get_rag_system overridden to the mock."""
+    test_app = create_test_app()
+    test_app.dependency_overrides[get_rag_system] = lambda: mock_rag_system
+    yield test_app
+    test_app.dependency_overrides.clear()
+
+
+@pytest.fixture(scope="module")
+def client(app):
+    """TestClient for the test app, started once per module."""
+    # httpx.ASGITransport only serves httpx.AsyncClient; TestClient is the sync equivalent,
+    # and entering it here runs the app lifespan and transport setup once for all tests
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(autouse=True)
+def _reset_rag_mock(mock_rag_system):
+    """Undo per-test return values and side effects on the shared mock RAG system."""
+    reset_rag_system_mock(mock_rag_system)
 
 
 # ---------------------------------------------------------------------------
@@ -94,7 +135,7 @@ class TestQueryEndpoint:
 
         assert resp.status_code == 200
         assert resp.json()["session_id"] == "my_session"
-        mock_rag_system.query.assert_called_once_with("Follow-up", "my_session")
+        mock_rag_system.aquery.assert_awaited_once_with("Follow-up", "my_session")
 
     def test_query_creates_session_when_missing(self, client, mock_rag_system):
         """When no session_id is sent, a new session is created."""
@@ -103,31 +144,45 @@ class TestQueryEndpoint:
         assert resp.status_code == 200
         mock_rag_system.session_manager.create_session.assert_called_once()
 
-    def test_query_missing_body_returns_422(self, client):
-        """Request with no JSON body returns 422 Unprocessable Entity."""
-        resp = client.post("/api/query")
-        assert resp.status_code == 422
+    def test_query_empty_string(self, client, mock_rag_system):
+        """Empty-string query is still forwarded to RAG system (validation is app-level)."""
+        resp = client.post("/api/query", json={"query": ""})
 
-    def test_query_missing_query_field_returns_422(self, client):
-        """Request missing required 'query' field returns 422."""
-        resp = client.post("/api/query", json={"session_id": "abc"})
-        assert resp.status_code == 422
+        assert resp.status_code == 200
+        mock_rag_system.aquery.assert_awaited_once()
 
-    def test_query_rag_error_returns_500(self, client, mock_rag_system):
-        """When rag_system.query() raises, endpoint returns 500."""
-        mock_rag_system.query.side_effect = RuntimeError("Model API unavailable")
 
-        resp = client.post("/api/query", json={"query": "Will fail"})
+# ---------------------------------------------------------------------------
+# /api/query/stream endpoint
+# ---------------------------------------------------------------------------
 
-        assert resp.status_code == 500
-        assert "Model API unavailable" in resp.json()["detail"]
+class TestQueryStreamEndpoint:
+    """Tests for POST /api/query/stream."""
 
-    def test_query_empty_string(self, client, mock_rag_system):
-        """Empty-string query is still forwarded to RAG system (validation is app-level)."""
-        resp = client.post("/api/query", json={"query": ""})
+    def test_stream_returns_ndjson_events(self, client):
+        """Streams delta events, then a done event with sources and session_id."""
+        resp = client.post("/api/query/stream", json={"query": "What is AI?"})
 
         assert resp.status_code == 200
-        mock_rag_system.query.assert_called_once()
+        assert resp.headers["content-type"].startswith("application/x-ndjson")
+        events = [json.loads(line) for line in resp.text.splitlines()]
+        assert "".join(e["text"] for e in events if e["type"] == "delta") == "This is a test answer."
+        assert events[-1] == {
+            "type": "done",
+            "sources": ["Intro to AI - Lesson 1"],
+            "session_id": "session_42",
+        }
+
+    def test_stream_error_reported_in_band(self, client, mock_rag_system):
+        """Errors raised mid-stream arrive as a final error event."""
+        mock_rag_system.astream_query.side_effect = RuntimeError("Model API unavailable")
+
+        resp = client.post("/api/query/stream", json={"query": "Will fail"})
+
+        assert resp.status_code == 200
+        assert json.loads(resp.text.splitlines()[-1]) == {
+            "type": "error", "detail": "Model API unavailable"
+        }
 
 
 # ---------------------------------------------------------------------------
@@ -147,15 +202,6 @@ class TestCoursesEndpoint:
         assert "Intro to AI" in data["course_titles"]
         assert len(data["course_titles"]) == 3
 
-    def test_courses_error_returns_500(self, client, mock_rag_system):
-        """When get_course_analytics() raises, endpoint returns 500."""
-        mock_rag_system.get_course_analytics.side_effect = RuntimeError("DB connection lost")
-
-        resp = client.get("/api/courses")
-
-        assert resp.status_code == 500
-        assert "DB connection lost" in resp.json()["detail"]
-
     def test_courses_empty_catalog(self, client, mock_rag_system):
         """Empty course catalog returns zero counts."""
         mock_rag_system.get_course_analytics.return_value = {
@@ -172,18 +218,39 @@ class TestCoursesEndpoint:
 
 
 # ---------------------------------------------------------------------------
-# Unknown routes
+# Error responses across endpoints
 # ---------------------------------------------------------------------------
 
-class TestUnknownRoutes:
-    """Tests for routes not defined in the API."""
+def _fail_query(rag):
+    rag.aquery.side_effect = RuntimeError("Model API unavailable")
+
+
+def _fail_analytics(rag):
+    rag.get_course_analytics.side_effect = RuntimeError("DB connection lost")
+
+
+class TestErrorResponses:
+    """Status codes (and details) for failing or invalid requests."""
+
+    @pytest.mark.parametrize("method,path,body,setup,expected_status,expected_detail", [
+        ("POST", "/api/query", None, None, 422, None),
+        ("POST", "/api/query", {"session_id": "abc"}, None, 422, None),
+        ("POST", "/api/query", {"query": "Will fail"}, _fail_query, 500, "Model API unavailable"),
+        ("GET", "/api/courses", None, _fail_analytics, 500, "DB connection lost"),
+        ("GET", "/api/nonexistent", None, None, 404, None),
+        ("GET", "/api/query", None, None, 405, None),
+    ], ids=[
+        "query_missing_body", "query_missing_query_field", "query_rag_error",
+        "courses_error", "unknown_route", "wrong_method",
+    ])
+    def test_error_status(self, client, mock_rag_system, method, path, body, setup,
+                          expected_status, expected_detail):
+        """Failing or invalid requests return the expected status and error detail."""
+        if setup:
+            setup(mock_rag_system)
 
-    def test_unknown_route_returns_404(self, client):
-        """GET to undefined path returns 404."""
-        resp = client.get("/api/nonexistent")
-        assert resp.status_code == 404
+        resp = client.request(method, path, json=body)
 
-    def test_wrong_method_returns_405(self, client):
-        """GET on POST-only endpoint returns 405."""
-        resp = client.get("/api/query")
-        assert resp.status_code == 405
+        assert resp.status_code == expected_status
+        if expected_detail:
+            assert expected_detail in resp.json()["detail"]
@@ -1,48 +1,81 @@
-import sys
-import os
+import asyncio
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock
 
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from config import config
+from ai_generator import STREAM_RESET
+from rag_system import RAGSystem
+from search_tools import RequestToolManager
+from session_manager import Message, SessionManager
+from vector_store import SearchResults, VectorStore
 
-from vector_store import SearchResults
+pytestmark = pytest.mark.xdist_group("rag_system")
+
+
+@pytest.fixture(scope="module")
+def patched_vector_store_deps():
+    """Stub out ChromaDB and the embedding model for the module; yields the mock collection."""
+    mock_collection = MagicMock()
+    mock_chroma_client = MagicMock()
+    mock_chroma_client.get_or_create_collection.return_value = mock_collection
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("vector_store.chromadb.PersistentClient", lambda *args, **kwargs: mock_chroma_client)
+        mp.setattr(
+            "vector_store.chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction",
+            MagicMock()
+        )
+        yield mock_collection
+
+
+@pytest.fixture(scope="module")
+def chroma_path(tmp_path_factory):
+    """Per-worker ChromaDB directory, so parallel runs never share a path."""
+    return str(tmp_path_factory.mktemp("chroma"))
+
+
+@pytest.fixture
+def mock_collection(patched_vector_store_deps):
+    """The module's mock ChromaDB collection, with calls and return values cleared."""
+    patched_vector_store_deps.reset_mock(return_value=True, side_effect=True)
+    return patched_vector_store_deps
+
+
+def _search_results_titled_by_query(query, course_name=None, lesson_number=None):
+    """store.search() side effect returning one lesson-1 hit whose course title is the query."""
+    return SearchResults(
+        documents=[f"About {query}"],
+        metadata=[{"course_title": query, "lesson_number": 1}],
+        distances=[0.1],
+    )
 
 
 class TestMaxResultsBug:
     """Tests documenting the MAX_RESULTS=0 bug."""
 
-    def test_max_results_zero_guarded_by_fallback(self):
+    def test_max_results_zero_guarded_by_fallback(self, mock_collection, chroma_path):
         """Defensive guard: VectorStore with max_results=0 falls back to 5 instead of failing."""
-        mock_chroma_client = MagicMock()
-        mock_collection = MagicMock()
         mock_collection.query.return_value = {
             "documents": [["chunk 1"]],
             "metadatas": [[{"course_title": "Test", "lesson_number": 1}]],
             "distances": [[0.1]]
         }
-        mock_chroma_client.get_or_create_collection.return_value = mock_collection
-
-        with patch("vector_store.chromadb.PersistentClient", return_value=mock_chroma_client), \
-             patch("vector_store.chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction"):
-            from vector_store import VectorStore
-            store = VectorStore(
-                chroma_path="/tmp/test_chroma",
-                embedding_model="test-model",
-                max_results=0
-            )
-
-            results = store.search(query="test query")
-
-            assert results.error is None
-            # Verify the fallback sent n_results=5 to ChromaDB
-            mock_collection.query.assert_called_once()
-            call_kwargs = mock_collection.query.call_args.kwargs
-            assert call_kwargs["n_results"] == 5
-
-    def test_max_results_positive_searches_succeed(self):
+
+        store = VectorStore(
+            chroma_path=chroma_path,
+            embedding_model="test-model",
+            max_results=0
+        )
+
+        results = store.search(query="test query")
+
+        assert results.error is None
+        # Verify the fallback sent n_results=5 to ChromaDB
+        mock_collection.query.assert_called_once()
+        call_kwargs = mock_collection.query.call_args.kwargs
+        assert call_kwargs["n_results"] == 5
+
+    def test_max_results_positive_searches_succeed(self, mock_collection, chroma_path):
         """VectorStore with max_results=5 succeeds when ChromaDB returns results."""
-        mock_chroma_client = MagicMock()
-        mock_collection = MagicMock()
         mock_collection.query.return_value = {
             "documents": [["chunk 1", "chunk 2"]],
             "metadatas": [[
@@ -51,25 +84,20 @@ class TestMaxResultsBug:
             ]],
             "distances": [[0.1, 0.2]]
         }
-        mock_chroma_client.get_or_create_collection.return_value = mock_collection
 
-        with patch("vector_store.chromadb.PersistentClient", return_value=mock_chroma_client), \
-             patch("vector_store.chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction"):
-            from vector_store import VectorStore
-            store = VectorStore(
-                chroma_path="/tmp/test_chroma",
-                embedding_model="test-model",
-                max_results=5
-            )
+        store = VectorStore(
+            chroma_path=chroma_path,
+            embedding_model="test-model",
+            max_results=5
+        )
 
-            results = store.search(query="test query")
+        results = store.search(query="test query")
 
-            assert results.error is None
-            assert len(results.documents) == 2
+        assert results.error is None
+        assert len(results.documents) == 2
 
     def test_config_max_results_is_positive(self):
         """Verifies config.MAX_RESULTS is a positive value (bug was MAX_RESULTS=0)."""
-        from config import config
         assert config.MAX_RESULTS > 0, (
             f"MAX_RESULTS must be positive, got {config.MAX_RESULTS}"
         )
@@ -78,8 +106,9 @@ class TestMaxResultsBug:
 class TestRAGSystemQuery:
     """Tests for RAGSystem.query() orchestration."""
 
-    @pytest.fixture
-    def mock_config(self):
+    @pytest.fixture(scope="class")
+    @classmethod
+    def mock_config(cls):
         config = MagicMock()
         config.CHUNK_SIZE = 800
         config.CHUNK_OVERLAP = 100
@@ -89,52 +118,81 @@ class TestRAGSystemQuery:
         config.ANTHROPIC_API_KEY = "test-key"
         config.ANTHROPIC_MODEL = "test-model"
         config.MAX_HISTORY = 2
+        config.RESPONSE_CACHE_SIZE = 1024
+        config.SEMANTIC_CACHE_THRESHOLD = 0.08
+        config.SEMANTIC_CACHE_SIZE = 10000
+        config.RATE_LIMIT_REQUESTS_PER_MINUTE = 40
+        config.RATE_LIMIT_TOKENS_PER_MINUTE = 16000
+        config.MAX_CONCURRENT_REQUESTS = 10
+        config.HISTORY_TOKEN_BUDGET = 2000
         return config
 
-    @pytest.fixture
-    def rag_system(self, mock_config):
-        """RAGSystem with all components mocked."""
-        with patch("rag_system.DocumentProcessor"), \
-             patch("rag_system.VectorStore") as MockVS, \
-             patch("rag_system.AIGenerator") as MockAI, \
-             patch("rag_system.SessionManager") as MockSM:
-
-            mock_vs_instance = MockVS.return_value
-            mock_ai_instance = MockAI.return_value
-            mock_sm_instance = MockSM.return_value
-
-            mock_ai_instance.generate_response.return_value = "AI response"
-            mock_sm_instance.get_conversation_history.return_value = None
+    @pytest.fixture(scope="class")
+    @classmethod
+    def rag_system(cls, mock_config):
+        """RAGSystem with all components mocked, shared by the class."""
+        mock_vs_instance, mock_ai_instance, mock_sm_instance = MagicMock(), MagicMock(), MagicMock()
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr("rag_system.DocumentProcessor", MagicMock())
+            mp.setattr("rag_system.VectorStore", MagicMock(return_value=mock_vs_instance))
+            mp.setattr("rag_system.AIGenerator", MagicMock(return_value=mock_ai_instance))
+            mp.setattr("rag_system.SessionManager", MagicMock(return_value=mock_sm_instance))
 
-            from rag_system import RAGSystem
             system = RAGSystem(mock_config)
 
             # Expose mocks for assertions
             system._mock_ai = mock_ai_instance
             system._mock_sm = mock_sm_instance
             system._mock_vs = mock_vs_instance
-            return system
+            yield system
+
+    @pytest.fixture(autouse=True)
+    def _reset_rag_mocks(self, rag_system):
+        """Clear calls and per-test behavior from the shared mocks, then reinstall defaults."""
+        for mock in (rag_system._mock_ai, rag_system._mock_sm, rag_system._mock_vs):
+            mock.reset_mock(return_value=True, side_effect=True)
+        rag_system._mock_ai.agenerate_response = AsyncMock(return_value="AI response")
+        rag_system._mock_sm.get_conversation_history.return_value = None
+        rag_system._mock_sm.get_summary.return_value = None
+        rag_system._mock_sm.estimate_history_tokens.return_value = 0
+        rag_system._mock_sm.has_trimmed_messages.return_value = False
 
     def test_query_calls_ai_with_tools(self, rag_system):
         """RAGSystem.query() passes tool definitions and tool_manager to ai_generator."""
         rag_system.query("What is AI?")
 
-        call_kwargs = rag_system._mock_ai.generate_response.call_args.kwargs
-        assert "tools" in call_kwargs
-        assert "tool_manager" in call_kwargs
-        assert call_kwargs["tool_manager"] is rag_system.tool_manager
+        call_kwargs = rag_system._mock_ai.agenerate_response.call_args.kwargs
+        assert call_kwargs["tools"] == rag_system.tool_manager.get_tool_definitions()
+        # A per-request view over the shared registry, so sources stay with their request
+        assert isinstance(call_kwargs["tool_manager"], RequestToolManager)
+        assert call_kwargs["tool_manager"].manager is rag_system.tool_manager
+        # The semantic cache embeds the bare question, not the prompt template around it
+        assert call_kwargs["semantic_query"] == "What is AI?"
 
-    def test_query_extracts_and_resets_sources(self, rag_system):
-        """After query, get_last_sources() called then reset_sources() called."""
-        # Spy on tool_manager methods
-        rag_system.tool_manager.get_last_sources = MagicMock(return_value=[{"text": "Source", "link": "url"}])
-        rag_system.tool_manager.reset_sources = MagicMock()
+    def test_query_returns_sources_of_its_own_searches(self, rag_system):
+        """Each query returns its own sources, even when queries run concurrently."""
+        rag_system._mock_vs.search.side_effect = _search_results_titled_by_query
+        rag_system._mock_vs.get_lesson_link.return_value = None
+        first_searched = asyncio.Event()
 
-        response, sources = rag_system.query("What is AI?")
+        async def fake_generate(**kwargs):
+            question = kwargs["query"].rsplit(": ", 1)[-1]
+            await asyncio.to_thread(kwargs["tool_manager"].execute_tool, "search_course_content", query=question)
+            if question == "A":
+                first_searched.set()
+                await asyncio.sleep(0.01)  # Let B search and finish while A is still in flight
+            else:
+                await first_searched.wait()
+            return f"Answer {question}"
+        rag_system._mock_ai.agenerate_response = AsyncMock(side_effect=fake_generate)
+
+        async def run():
+            return await asyncio.gather(rag_system.aquery("A"), rag_system.aquery("B"))
+        (answer_a, sources_a), (answer_b, sources_b) = asyncio.run(run())
 
-        rag_system.tool_manager.get_last_sources.assert_called_once()
-        rag_system.tool_manager.reset_sources.assert_called_once()
-        assert sources == [{"text": "Source", "link": "url"}]
+        assert (answer_a, sources_a) == ("Answer A", [{"text": "A - Lesson 1", "link": None}])
+        assert (answer_b, sources_b) == ("Answer B", [{"text": "B - Lesson 1", "link": None}])
+        assert rag_system.search_tool.last_sources == []
 
     def test_query_updates_session_history(self, rag_system):
         """session_manager.add_exchange() called with query and response."""
@@ -153,3 +211,120 @@ class TestRAGSystemQuery:
         assert response == "AI response"
         rag_system._mock_sm.get_conversation_history.assert_not_called()
         rag_system._mock_sm.add_exchange.assert_not_called()
+
+    def test_stream_query_yields_deltas_then_sources(self, rag_system):
+        """astream_query() yields text deltas, then sources, and records the full answer."""
+        rag_system._mock_vs.search.side_effect = _search_results_titled_by_query
+        rag_system._mock_vs.get_lesson_link.return_value = None
+
+        async def fake_stream(**kwargs):
+            kwargs["tool_manager"].execute_tool("search_course_content", query="Source")
+            yield "AI "
+            yield "response"
+        rag_system._mock_ai.stream_response = MagicMock(side_effect=fake_stream)
+
+        async def collect():
+            return [event async for event in rag_system.astream_query("What is AI?", session_id="session_1")]
+        events = asyncio.run(collect())
+
+        assert events == [
+            {"type": "delta", "text": "AI "},
+            {"type": "delta", "text": "response"},
+            {"type": "done", "sources": [{"text": "Source - Lesson 1", "link": None}]},
+        ]
+        rag_system._mock_sm.add_exchange.assert_called_once_with("session_1", "What is AI?", "AI response")
+
+    def test_stream_query_reset_voids_preamble(self, rag_system):
+        """A STREAM_RESET becomes a reset event and the preamble is left out of history."""
+        async def fake_stream(**kwargs):
+            yield "Let me search."
+            yield STREAM_RESET
+            yield "AI response"
+        rag_system._mock_ai.stream_response = MagicMock(side_effect=fake_stream)
+
+        async def collect():
+            return [event async for event in rag_system.astream_query("What is AI?", session_id="session_1")]
+        events = asyncio.run(collect())
+
+        assert [event["type"] for event in events] == ["delta", "reset", "delta", "done"]
+        assert rag_system._mock_ai.stream_response.call_args.kwargs["allow_reset"] is True
+        rag_system._mock_sm.add_exchange.assert_called_once_with("session_1", "What is AI?", "AI response")
+
+    def test_query_passes_conversation_summary(self, rag_system):
+        """The session's summary of earlier turns is forwarded to ai_generator."""
+        rag_system._mock_sm.get_summary.return_value = "User asked about MCP basics."
+
+        rag_system.query("And servers?", session_id="session_1")
+
+        call_kwargs = rag_system._mock_ai.agenerate_response.call_args.kwargs
+        assert call_kwargs["conversation_summary"] == "User asked about MCP basics."
+
+    def test_history_over_budget_is_compacted_in_background(self, rag_system):
+        """Exceeding HISTORY_TOKEN_BUDGET summarizes older turns without delaying the answer."""
+        older = [Message("user", "What is MCP?"), Message("assistant", "A protocol.")]
+        rag_system._mock_sm.estimate_history_tokens.return_value = 5000
+        rag_system._mock_sm.messages_to_summarize.return_value = older
+        rag_system._mock_sm.format_messages.side_effect = SessionManager.format_messages
+        rag_system._mock_ai.summarize_history = AsyncMock(return_value="User learned MCP is a protocol.")
+
+        async def run():
+            response, _ = await rag_system.aquery("And servers?", session_id="session_1")
+            assert rag_system._compactions  # Compaction still pending when the answer returns
+            await asyncio.gather(*rag_system._compactions.values())
+            return response
+        assert asyncio.run(run()) == "AI response"
+
+        rag_system._mock_sm.messages_to_summarize.assert_called_once_with("session_1", 2)
+        rag_system._mock_ai.summarize_history.assert_awaited_once_with(
+            "User: What is MCP?\nAssistant: A protocol.", None
+        )
+        rag_system._mock_sm.apply_summary.assert_called_once_with(
+            "session_1", "User learned MCP is a protocol.", older
+        )
+
+    def test_sync_query_applies_summary_before_returning(self, rag_system, monkeypatch):
+        """query() finishes the compaction it schedules instead of losing it when its loop closes."""
+        session_manager = SessionManager(max_history=1)
+        monkeypatch.setattr(rag_system, "session_manager", session_manager)
+        async def fake_summarize(history, previous_summary):
+            await asyncio.sleep(0.01)  # Still in flight when aquery() returns, like a real API call
+            return "User asked what MCP is."
+        rag_system._mock_ai.summarize_history = AsyncMock(side_effect=fake_summarize)
+
+        rag_system.query("What is MCP?", session_id="s")
+        rag_system.query("And servers?", session_id="s")
+
+        assert session_manager.get_summary("s") == "User asked what MCP is."
+        assert not session_manager.has_trimmed_messages("s")
+        assert not rag_system._compactions
+
+    def test_trimmed_turns_are_summarized_once_per_compaction(self, rag_system, monkeypatch):
+        """Turns dropped from the window are summarized, with one compaction in flight per session."""
+        session_manager = SessionManager(max_history=1)
+        monkeypatch.setattr(rag_system, "session_manager", session_manager)
+        release = asyncio.Event()
+
+        async def fake_summarize(history, previous_summary):
+            await release.wait()
+            return f"Summary of: {history}"
+        rag_system._mock_ai.summarize_history = AsyncMock(side_effect=fake_summarize)
+
+        async def run():
+            await rag_system.aquery("What is MCP?", session_id="s")
+            assert not rag_system._compactions  # Window not full yet
+            await rag_system.aquery("And servers?", session_id="s")
+            compaction = rag_system._compactions["s"]
+            await asyncio.sleep(0)  # Let it take the trimmed turns and block in summarize_history
+            await rag_system.aquery("And clients?", session_id="s")
+            assert rag_system._compactions["s"] is compaction  # Not scheduled twice
+            release.set()
+            await compaction
+        asyncio.run(run())
+
+        rag_system._mock_ai.summarize_history.assert_awaited_once_with(
+            "User: What is MCP?\nAssistant: AI response", None
+        )
+        assert session_manager.get_summary("s") == "Summary of: User: What is MCP?\nAssistant: AI response"
+        # The second exchange was trimmed while the first compaction ran; it waits for the next one
+        assert [msg.content for msg in session_manager.trimmed["s"]] == ["And servers?", "AI response"]
+        assert [msg.content for msg in session_manager.sessions["s"]] == ["And clients?", "AI response"]
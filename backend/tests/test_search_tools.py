@@ -1,101 +1,82 @@
-import sys
-import os
 import pytest
-from unittest.mock import MagicMock
 
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-sys.path.insert(0, os.path.dirname(__file__))
+from search_tools import CourseSearchTool, CourseOutlineTool, ToolManager
 
-from search_tools import CourseSearchTool, ToolManager
-from vector_store import SearchResults
-from conftest import sample_search_results
 
+@pytest.fixture(autouse=True)
+def _reset_vector_store(fake_vector_store):
+    """Undo per-test returns and recorded calls on the shared fake VectorStore."""
+    yield
+    fake_vector_store.reset()
 
-class TestCourseSearchToolExecute:
-    """Tests for CourseSearchTool.execute()"""
-
-    def test_execute_successful_search(self, mock_vector_store):
-        """Returns formatted results with [Course - Lesson N] headers, populates last_sources."""
-        mock_vector_store.search.return_value = sample_search_results("success")
-        mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson1"
-        tool = CourseSearchTool(mock_vector_store)
-
-        result = tool.execute(query="AI basics")
-
-        assert "[Intro to AI - Lesson 1]" in result
-        assert "Chunk about AI basics" in result
-        assert "[Intro to AI - Lesson 2]" in result
-        assert "Chunk about neural networks" in result
-        assert len(tool.last_sources) == 2
-
-    def test_execute_empty_results(self, mock_vector_store):
-        """Returns 'No relevant content found' message."""
-        mock_vector_store.search.return_value = sample_search_results("empty")
-        tool = CourseSearchTool(mock_vector_store)
-
-        result = tool.execute(query="nonexistent topic")
-
-        assert "No relevant content found" in result
-
-    def test_execute_error_results(self, mock_vector_store):
-        """Returns error string directly when SearchResults.error is set."""
-        mock_vector_store.search.return_value = sample_search_results("error")
-        tool = CourseSearchTool(mock_vector_store)
-
-        result = tool.execute(query="anything")
-
-        assert "Search error:" in result
-
-    def test_execute_with_course_filter(self, mock_vector_store):
-        """Passes course_name to store.search()."""
-        mock_vector_store.search.return_value = sample_search_results("empty")
-        tool = CourseSearchTool(mock_vector_store)
-
-        tool.execute(query="AI", course_name="Intro to AI")
-
-        mock_vector_store.search.assert_called_once_with(
-            query="AI", course_name="Intro to AI", lesson_number=None
-        )
 
-    def test_execute_with_lesson_filter(self, mock_vector_store):
-        """Passes lesson_number to store.search()."""
-        mock_vector_store.search.return_value = sample_search_results("empty")
-        tool = CourseSearchTool(mock_vector_store)
+@pytest.fixture
+def registered_manager(fake_vector_store):
+    """A ToolManager with a CourseSearchTool on the fake store registered; yields (manager, tool)."""
+    tool = CourseSearchTool(fake_vector_store)
+    manager = ToolManager()
+    manager.register_tool(tool)
+    return manager, tool
 
-        tool.execute(query="AI", lesson_number=3)
 
-        mock_vector_store.search.assert_called_once_with(
-            query="AI", course_name=None, lesson_number=3
-        )
-
-    def test_execute_with_both_filters(self, mock_vector_store):
-        """Passes both filters to store.search()."""
-        mock_vector_store.search.return_value = sample_search_results("empty")
-        tool = CourseSearchTool(mock_vector_store)
-
-        tool.execute(query="AI", course_name="Intro to AI", lesson_number=2)
-
-        mock_vector_store.search.assert_called_once_with(
-            query="AI", course_name="Intro to AI", lesson_number=2
-        )
+class TestCourseSearchToolExecute:
+    """Tests for CourseSearchTool.execute()"""
 
-    def test_sources_include_lesson_links(self, mock_vector_store):
+    @pytest.mark.parametrize("variant,kwargs,expected_call,expected_fragments,expected_source_count", [
+        ("success", {"query": "AI basics"},
+         {"query": "AI basics", "course_name": None, "lesson_number": None},
+         ["[Intro to AI - Lesson 1]", "Chunk about AI basics",
+          "[Intro to AI - Lesson 2]", "Chunk about neural networks"], 2),
+        ("empty", {"query": "nonexistent topic"},
+         {"query": "nonexistent topic", "course_name": None, "lesson_number": None},
+         ["No relevant content found"], 0),
+        ("error", {"query": "anything"},
+         {"query": "anything", "course_name": None, "lesson_number": None},
+         ["Search error:"], 0),
+        ("empty", {"query": "AI", "course_name": "Intro to AI"},
+         {"query": "AI", "course_name": "Intro to AI", "lesson_number": None},
+         ["No relevant content found"], 0),
+        ("empty", {"query": "AI", "lesson_number": 3},
+         {"query": "AI", "course_name": None, "lesson_number": 3},
+         ["No relevant content found"], 0),
+        ("empty", {"query": "AI", "course_name": "Intro to AI", "lesson_number": 2},
+         {"query": "AI", "course_name": "Intro to AI", "lesson_number": 2},
+         ["No relevant content found"], 0),
+    ], ids=[
+        "successful_search", "empty_results", "error_results",
+        "course_filter", "lesson_filter", "both_filters",
+    ])
+    def test_execute(self, fake_vector_store, sample_search_results, variant, kwargs, expected_call,
+                     expected_fragments, expected_source_count):
+        """Forwards filters to store.search() and formats results, empty results, or the error."""
+        fake_vector_store.search_results = sample_search_results(variant)
+        fake_vector_store.lesson_link = "https://example.com/lesson1"
+        tool = CourseSearchTool(fake_vector_store)
+
+        result = tool.execute(**kwargs)
+
+        assert fake_vector_store.search_calls == [expected_call]
+        for fragment in expected_fragments:
+            assert fragment in result
+        assert len(tool.last_sources) == expected_source_count
+
+    def test_sources_include_lesson_links(self, fake_vector_store, sample_search_results):
         """last_sources entries have text and link from get_lesson_link()."""
-        mock_vector_store.search.return_value = sample_search_results("success")
-        mock_vector_store.get_lesson_link.return_value = "https://example.com/lesson"
-        tool = CourseSearchTool(mock_vector_store)
+        fake_vector_store.search_results = sample_search_results("success")
+        fake_vector_store.lesson_link = "https://example.com/lesson"
+        tool = CourseSearchTool(fake_vector_store)
 
         tool.execute(query="AI basics")
 
         assert len(tool.last_sources) == 2
-        for source in tool.last_sources:
-            assert "text" in source
-            assert "link" in source
-            assert source["link"] == "https://example.com/lesson"
+        assert all(
+            {"text", "link"} <= source.keys() and source["link"] == "https://example.com/lesson"
+            for source in tool.last_sources
+        )
 
-    def test_tool_definition_schema(self, mock_vector_store):
+    def test_tool_definition_schema(self, fake_vector_store):
         """get_tool_definition() returns correct name/schema."""
-        tool = CourseSearchTool(mock_vector_store)
+        tool = CourseSearchTool(fake_vector_store)
         definition = tool.get_tool_definition()
 
         assert definition["name"] == "search_course_content"
@@ -107,16 +88,15 @@ class TestCourseSearchToolExecute:
 class TestToolManager:
     """Tests for ToolManager dispatch and source management."""
 
-    def test_tool_manager_dispatches_correctly(self, mock_vector_store):
+    def test_tool_manager_dispatches_correctly(self, registered_manager, fake_vector_store,
+                                              sample_search_results):
         """ToolManager.execute_tool('search_course_content', ...) calls CourseSearchTool.execute()."""
-        mock_vector_store.search.return_value = sample_search_results("empty")
-        tool = CourseSearchTool(mock_vector_store)
-        manager = ToolManager()
-        manager.register_tool(tool)
+        fake_vector_store.search_results = sample_search_results("empty")
+        manager, _ = registered_manager
 
         result = manager.execute_tool("search_course_content", query="test query")
 
-        mock_vector_store.search.assert_called_once()
+        assert len(fake_vector_store.search_calls) == 1
         assert "No relevant content found" in result
 
     def test_tool_manager_unknown_tool(self):
@@ -127,16 +107,58 @@ class TestToolManager:
 
         assert "not found" in result
 
-    def test_tool_manager_source_reset(self, mock_vector_store):
+    def test_tool_manager_source_reset(self, registered_manager, fake_vector_store, sample_search_results):
         """reset_sources() clears last_sources."""
-        mock_vector_store.search.return_value = sample_search_results("success")
-        mock_vector_store.get_lesson_link.return_value = "https://example.com"
-        tool = CourseSearchTool(mock_vector_store)
-        manager = ToolManager()
-        manager.register_tool(tool)
+        fake_vector_store.search_results = sample_search_results("success")
+        fake_vector_store.lesson_link = "https://example.com"
+        manager, tool = registered_manager
 
         manager.execute_tool("search_course_content", query="AI")
         assert len(manager.get_last_sources()) > 0
 
         manager.reset_sources()
         assert len(manager.get_last_sources()) == 0
+        assert tool.last_sources == []
+
+    def test_request_view_keeps_its_own_sources(self, registered_manager, fake_vector_store,
+                                                sample_search_results):
+        """for_request() views collect their calls' sources without touching the shared tool."""
+        fake_vector_store.search_results = sample_search_results("success")
+        fake_vector_store.lesson_link = "https://example.com"
+        manager, tool = registered_manager
+        first, second = manager.for_request(), manager.for_request()
+
+        first.execute_tool("search_course_content", query="AI")
+
+        assert [source["text"] for source in first.get_last_sources()] == [
+            "Intro to AI - Lesson 1", "Intro to AI - Lesson 2"
+        ]
+        assert second.get_last_sources() == []
+        assert tool.last_sources == []
+
+    def test_tool_definitions_built_once_per_registry(self, fake_vector_store):
+        """get_tool_definitions() returns the same list until another tool is registered."""
+        manager = ToolManager()
+        manager.register_tool(CourseSearchTool(fake_vector_store))
+
+        definitions = manager.get_tool_definitions()
+        assert manager.get_tool_definitions() is definitions
+
+        manager.register_tool(CourseOutlineTool(fake_vector_store))
+        assert [d["name"] for d in manager.get_tool_definitions()] == [
+            "search_course_content", "get_course_outline"
+        ]
+
+    def test_tool_manager_predicts_outline_call(self, fake_vector_store):
+        """Outline requests naming a known course predict get_course_outline with that title."""
+        fake_vector_store.course_titles = ["Intro to AI", "MCP Basics"]
+        manager = ToolManager()
+        manager.register_tool(CourseSearchTool(fake_vector_store))
+        manager.register_tool(CourseOutlineTool(fake_vector_store))
+
+        assert manager.predict_tool_call("What is the outline of mcp basics?") == (
+            "get_course_outline", {"course_name": "MCP Basics"}
+        )
+        # No outline keyword, or no course named in full: Claude's choice isn't predictable
+        assert manager.predict_tool_call("What does MCP Basics say about servers?") is None
+        assert manager.predict_tool_call("Show me the outline of the MCP course") is None